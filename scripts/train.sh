@@ -171,15 +171,15 @@ if [ "$SKIP_TRAIN" = false ]; then
     echo ""
 
     # Run training with clean progress output
-    python3 train_progress.py "$TOTAL_ITERS" \
-        python3 finetune_mlx.py \
+    python3 finetune_mlx.py \
         --model "$BASE_MODEL" \
         --dataset "$TRAINING_DATA" \
         --output-dir "$LORA_OUTPUT_DIR" \
         --num-epochs "$EPOCHS" \
         --batch-size "$BATCH_SIZE" \
         --learning-rate 4e-5 \
-        --lora-rank 16
+        --lora-rank 16 \
+        --progress
 
     echo ""
     echo -e "${GREEN}✓ Training complete${NC}"
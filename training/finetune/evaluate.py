@@ -10,24 +10,35 @@ Evaluates fine-tuned models on test data for:
 """
 
 import argparse
+import copy
 import json
-import re
+import os
+from array import array
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
+import numpy as np
+import orjson
 import torch
 from datasets import load_dataset
 from rich.console import Console
 from rich.table import Table
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
 from peft import PeftModel
 
 
 console = Console()
 
+SYSTEM_PROMPT = "You are an AI assistant that controls CesiumJS. Convert natural language commands into JSON tool calls."
+
+# Static ChatML (Qwen style) text surrounding each instruction
+CHATML_PREFIX = f"<|im_start|>system\n{SYSTEM_PROMPT}<|im_end|>\n<|im_start|>user\n"
+CHATML_SUFFIX = "<|im_end|>\n<|im_start|>assistant\n"
+
 
 @dataclass
 class EvalResult:
@@ -36,42 +47,101 @@ class EvalResult:
     predicted: str
     tool_match: bool
     json_valid: bool
-    coord_error: Optional[float]
+    coords: Optional[tuple[float, float, float, float]]
     exact_match: bool
+    expected_json: Optional[dict]
+    predicted_json: Optional[dict]
+
+
+def configure_torch_backends():
+    """Enable cuDNN autotuning and TF32 matmuls for inference."""
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
+
+def half_precision_dtype() -> torch.dtype:
+    """bf16 on Ampere and newer; fp16 on older GPUs, which lack fast bf16."""
+    cap = torch.cuda.get_device_capability() if torch.cuda.is_available() else (0, 0)
+    return torch.bfloat16 if cap[0] >= 8 else torch.float16
+
+
+def estimate_fp16_bytes(model_name: str) -> int:
+    """Estimate fp16 weight size by instantiating the architecture on the meta device."""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+
+    return 2 * sum(p.numel() for p in model.parameters())
 
 
 def load_model(
     model_path: str,
     base_model: Optional[str] = None,
     use_4bit: bool = False,
+    compile_model: bool = False,
 ):
     """Load model (supports LoRA adapters and full models)."""
 
+    # Check if this is a LoRA adapter
+    adapter_config_path = Path(model_path) / "adapter_config.json"
+    is_adapter = adapter_config_path.exists()
+
+    if is_adapter and base_model is None:
+        with open(adapter_config_path) as f:
+            adapter_config = json.load(f)
+            base_model = adapter_config.get("base_model_name_or_path")
+
+    # Adapter directories saved by the training scripts carry their own tokenizer;
+    # only fall back to the base model (possibly a Hub download) when they don't
+    tokenizer_path = model_path
+    if is_adapter and not (Path(model_path) / "tokenizer.json").exists():
+        tokenizer_path = base_model
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer_path,
+        trust_remote_code=True,
+        local_files_only=os.environ.get("HF_HUB_OFFLINE", "0").lower() in ("1", "true", "yes"),
+    )
+
+    # Batched generation needs left padding so prompts end at the same column
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # NF4 dequantization dominates decode on small models; only quantize if fp16 won't fit
+    if use_4bit and torch.cuda.is_available():
+        weight_bytes = estimate_fp16_bytes(base_model if is_adapter else model_path)
+        free_bytes, _ = torch.cuda.mem_get_info()
+        if weight_bytes * 1.2 <= free_bytes:
+            console.print(
+                f"[yellow]Warning:[/yellow] fp16 weights ({weight_bytes / 1e9:.1f} GB) fit in free VRAM "
+                f"({free_bytes / 1e9:.1f} GB); ignoring --use-4bit since NF4 decodes slower at this size."
+            )
+            use_4bit = False
+
     quantization_config = None
+    compute_dtype = half_precision_dtype()
     if use_4bit:
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_use_double_quant=True,
         )
 
-    # Check if this is a LoRA adapter
-    adapter_config_path = Path(model_path) / "adapter_config.json"
-
-    if adapter_config_path.exists():
+    if is_adapter:
         # Load base model and apply adapter
-        if base_model is None:
-            with open(adapter_config_path) as f:
-                adapter_config = json.load(f)
-                base_model = adapter_config.get("base_model_name_or_path")
-
         console.print(f"Loading base model: {base_model}")
         model = AutoModelForCausalLM.from_pretrained(
             base_model,
             trust_remote_code=True,
             quantization_config=quantization_config,
             device_map="auto",
-            torch_dtype=torch.bfloat16 if use_4bit else torch.float16,
+            torch_dtype=compute_dtype if use_4bit else torch.float16,
         )
 
         console.print(f"Loading LoRA adapter: {model_path}")
@@ -85,107 +155,341 @@ def load_model(
             trust_remote_code=True,
             quantization_config=quantization_config,
             device_map="auto",
-            torch_dtype=torch.bfloat16 if use_4bit else torch.float16,
+            torch_dtype=compute_dtype if use_4bit else torch.float16,
         )
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        base_model or model_path,
-        trust_remote_code=True,
-    )
+    # Compile the decoder forward (generate() calls it per step) on Volta+
+    if compile_model and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7:
+        console.print("Compiling model with torch.compile (mode=reduce-overhead)")
+        decoder = model.get_base_model() if isinstance(model, PeftModel) else model
+        decoder.forward = torch.compile(decoder.forward, mode="reduce-overhead", fullgraph=False)
 
     return model, tokenizer
 
 
-def generate_response(
+def format_chatml(instruction: str) -> str:
+    """Format an instruction as a ChatML (Qwen style) generation prompt."""
+    return f"{CHATML_PREFIX}{instruction}{CHATML_SUFFIX}"
+
+
+@lru_cache(maxsize=None)
+def get_chatml_token_ids(tokenizer) -> tuple[list[int], list[int]]:
+    """Tokenize the static ChatML prefix and suffix once per tokenizer."""
+    prefix_ids = tokenizer.encode(CHATML_PREFIX, add_special_tokens=False)
+    suffix_ids = tokenizer.encode(CHATML_SUFFIX, add_special_tokens=False)
+    return prefix_ids, suffix_ids
+
+
+def build_prefix_cache(model, tokenizer):
+    """Prefill the shared ChatML system prefix once and return its KV cache."""
+    prefix_ids, _ = get_chatml_token_ids(tokenizer)
+    input_ids = torch.tensor([prefix_ids], device=model.device)
+
+    with torch.inference_mode():
+        outputs = model(input_ids=input_ids, use_cache=True, return_dict=True)
+
+    return outputs.past_key_values
+
+
+def generate_responses(
     model,
     tokenizer,
-    instruction: str,
+    instructions: list[str],
     max_new_tokens: int = 256,
     temperature: float = 0.1,
-) -> str:
-    """Generate model response for an instruction."""
-
-    # Format as ChatML (Qwen style)
-    prompt = f"""<|im_start|>system
-You are an AI assistant that controls CesiumJS. Convert natural language commands into JSON tool calls.<|im_end|>
-<|im_start|>user
-{instruction}<|im_end|>
-<|im_start|>assistant
-"""
+    prefix_cache=None,
+) -> list[str]:
+    """Generate model responses for a batch of instructions in one generate call.
+
+    When prefix_cache (from build_prefix_cache) is given, the system prefix is
+    not prefilled again; generate only runs attention for the new tokens.
+    """
+
+    # Only the instructions go through the tokenizer; the ChatML frame is cached
+    prefix_ids, suffix_ids = get_chatml_token_ids(tokenizer)
+    user_ids = tokenizer(
+        instructions,
+        add_special_tokens=False,
+        truncation=True,
+        max_length=2048 - len(prefix_ids) - len(suffix_ids),
+    )["input_ids"]
+
+    past_key_values = None
+    if prefix_cache is None:
+        inputs = tokenizer.pad(
+            {"input_ids": [prefix_ids + ids + suffix_ids for ids in user_ids]},
+            padding=True,
+            return_tensors="pt",
+        ).to(model.device)
+    else:
+        # Pad between prefix and instruction so the cached prefix lines up across the batch
+        width = max(len(ids) for ids in user_ids) + len(suffix_ids)
+        rows, masks = [], []
+        for ids in user_ids:
+            tail = ids + suffix_ids
+            padding = width - len(tail)
+            rows.append(prefix_ids + [tokenizer.pad_token_id] * padding + tail)
+            masks.append([1] * len(prefix_ids) + [0] * padding + [1] * len(tail))
+
+        inputs = {
+            "input_ids": torch.tensor(rows, device=model.device),
+            "attention_mask": torch.tensor(masks, device=model.device),
+        }
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        # generate() extends the cache in place, so each batch gets its own copy
+        past_key_values = copy.deepcopy(prefix_cache)
+        past_key_values.batch_repeat_interleave(len(rows))
 
-    with torch.no_grad():
+    with torch.inference_mode():
         outputs = model.generate(
             **inputs,
+            past_key_values=past_key_values,
             max_new_tokens=max_new_tokens,
             temperature=temperature,
             do_sample=temperature > 0,
             top_p=0.9,
-            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+            use_cache=True,
+            pad_token_id=tokenizer.pad_token_id,
         )
 
-    response = tokenizer.decode(outputs[0], skip_special_tokens=False)
+    # Every prompt ends at the same column, so new tokens start right after it
+    generated = outputs[:, inputs["input_ids"].shape[1]:]
+
+    return [
+        response.strip()
+        for response in tokenizer.batch_decode(generated, skip_special_tokens=True)
+    ]
+
 
-    # Extract assistant response
-    if "<|im_start|>assistant" in response:
-        response = response.split("<|im_start|>assistant")[-1]
-    if "<|im_end|>" in response:
-        response = response.split("<|im_end|>")[0]
+def generate_with_vllm(
+    model_path: str,
+    instructions: list[str],
+    base_model: Optional[str] = None,
+    use_4bit: bool = False,
+    max_new_tokens: int = 256,
+    temperature: float = 0.1,
+    max_model_len: int = 4096,
+) -> list[str]:
+    """Generate responses for all instructions in one vLLM offline batch.
 
-    return response.strip()
+    vLLM schedules every prompt at once (PagedAttention + continuous
+    batching), so decode steps from different samples share GPU iterations.
+    """
+    try:
+        from vllm import LLM, SamplingParams
+        from vllm.lora.request import LoRARequest
+    except ImportError:
+        console.print("[red]vLLM not installed![/red] Install with: pip install vllm")
+        raise
+
+    lora_request = None
+    max_lora_rank = None
+    adapter_config_path = Path(model_path) / "adapter_config.json"
+
+    if adapter_config_path.exists():
+        with open(adapter_config_path) as f:
+            adapter_config = json.load(f)
+        if base_model is None:
+            base_model = adapter_config.get("base_model_name_or_path")
+        # vLLM only accepts power-of-two rank limits (8..512); round the adapter's r up
+        max_lora_rank = max(8, 1 << (adapter_config.get("r", 8) - 1).bit_length())
+        lora_request = LoRARequest("adapter", 1, model_path)
+        console.print(f"Loading base model: {base_model}")
+        console.print(f"Loading LoRA adapter: {model_path}")
+    else:
+        base_model = model_path
+        console.print(f"Loading model: {model_path}")
+
+    llm = LLM(
+        model=base_model,
+        dtype="bfloat16" if half_precision_dtype() == torch.bfloat16 else "float16",
+        enable_prefix_caching=True,
+        quantization="bitsandbytes" if use_4bit else None,
+        max_model_len=max_model_len,
+        enable_lora=lora_request is not None,
+        max_lora_rank=max_lora_rank or 16,
+        trust_remote_code=True,
+    )
+
+    sampling_params = SamplingParams(
+        temperature=temperature,
+        top_p=0.9,
+        max_tokens=max_new_tokens,
+        stop=["<|im_end|>"],
+    )
+
+    prompts = [format_chatml(instruction) for instruction in instructions]
+    outputs = llm.generate(prompts, sampling_params, lora_request=lora_request)
+
+    return [output.outputs[0].text.strip() for output in outputs]
+
+
+class RayPredictor:
+    """Ray Data actor that holds one model replica per GPU."""
+
+    def __init__(
+        self,
+        model_path: str,
+        base_model: Optional[str] = None,
+        use_4bit: bool = False,
+        compile_model: bool = False,
+        use_prefix_cache: bool = False,
+        max_new_tokens: int = 256,
+        temperature: float = 0.1,
+    ):
+        self.model, self.tokenizer = load_model(
+            model_path,
+            base_model=base_model,
+            use_4bit=use_4bit,
+            compile_model=compile_model,
+        )
+        self.model.eval()
+        configure_torch_backends()
+        self.prefix_cache = build_prefix_cache(self.model, self.tokenizer) if use_prefix_cache else None
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+
+    def __call__(self, batch: dict) -> dict:
+        batch["predicted"] = generate_responses(
+            self.model,
+            self.tokenizer,
+            list(batch["instruction"]),
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            prefix_cache=self.prefix_cache,
+        )
+        return batch
+
+
+def generate_with_ray(
+    model_path: str,
+    test_data,
+    num_gpus: int,
+    base_model: Optional[str] = None,
+    use_4bit: bool = False,
+    compile_model: bool = False,
+    use_prefix_cache: bool = False,
+    temperature: float = 0.1,
+    batch_size: int = 16,
+) -> Iterator[dict]:
+    """Shard generation across GPUs with a Ray Data actor pool."""
+    try:
+        import ray
+    except ImportError:
+        console.print("[red]Ray not installed![/red] Install with: pip install 'ray[data]'")
+        raise
+
+    ray.init(ignore_reinit_error=True)
+
+    ds = ray.data.from_items([
+        {"instruction": example["instruction"], "output": example["output"]}
+        for example in test_data
+    ])
+
+    return ds.map_batches(
+        RayPredictor,
+        fn_constructor_kwargs={
+            "model_path": model_path,
+            "base_model": base_model,
+            "use_4bit": use_4bit,
+            "compile_model": compile_model,
+            "use_prefix_cache": use_prefix_cache,
+            "temperature": temperature,
+        },
+        concurrency=num_gpus,
+        num_gpus=1,
+        batch_size=batch_size,
+    ).iter_rows()
+
+
+def _outer_object_spans(text: str) -> list[tuple[int, int]]:
+    """Return (start, end) spans of the outermost balanced {...} in text, in one pass.
+
+    Braces inside JSON string literals (including escaped quotes) are ignored,
+    and an unmatched "{" does not hide the balanced objects that follow it.
+    """
+    opens = []  # offsets of "{" not closed yet
+    spans = []  # closed spans not enclosed by a later-closing one
+    in_string = False
+    escaped = False
+
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            if opens:
+                in_string = True
+        elif c == "{":
+            opens.append(i)
+        elif c == "}" and opens:
+            start = opens.pop()
+            # This span encloses every span closed since its "{"
+            while spans and spans[-1][0] > start:
+                spans.pop()
+            spans.append((start, i + 1))
+
+    return spans
 
 
 def parse_json_output(text: str) -> Optional[dict]:
-    """Try to parse JSON from model output."""
+    """Try to parse JSON from model output.
+
+    >>> parse_json_output('Sure {here: {"tool":"flyTo","arguments":{"longitude":1}}')
+    {'tool': 'flyTo', 'arguments': {'longitude': 1}}
+    >>> parse_json_output("{" * 100000 + '{"tool":"flyTo"}')  # linear in len(text)
+    {'tool': 'flyTo'}
+    """
     # Clean up the text
     text = text.strip()
 
     # Try direct parse
     try:
         return json.loads(text)
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, RecursionError):
         pass
 
-    # Try to find JSON in the text
-    json_patterns = [
-        r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}',  # Nested JSON
-        r'\{.*?\}',  # Simple JSON
-    ]
-
-    for pattern in json_patterns:
-        matches = re.findall(pattern, text, re.DOTALL)
-        for match in matches:
-            try:
-                return json.loads(match)
-            except json.JSONDecodeError:
-                continue
+    # Try to find JSON in the text: each outermost balanced {...} is parsed
+    # at most once, so total work stays linear in the text length
+    for start, end in _outer_object_spans(text):
+        try:
+            return json.loads(text[start:end])
+        except (json.JSONDecodeError, RecursionError):
+            continue
 
     return None
 
 
-def compare_coordinates(expected: dict, predicted: dict) -> Optional[float]:
-    """Calculate coordinate error between expected and predicted."""
+def extract_coordinates(expected: dict, predicted: dict) -> Optional[tuple[float, float, float, float]]:
+    """Return (expected lon, expected lat, predicted lon, predicted lat), or None if not comparable."""
     try:
         expected_args = expected.get("arguments", {})
         predicted_args = predicted.get("arguments", {})
 
         if "longitude" in expected_args and "latitude" in expected_args:
-            exp_lon = float(expected_args["longitude"])
-            exp_lat = float(expected_args["latitude"])
-            pred_lon = float(predicted_args.get("longitude", 0))
-            pred_lat = float(predicted_args.get("latitude", 0))
-
-            # Euclidean distance in degrees
-            error = ((exp_lon - pred_lon) ** 2 + (exp_lat - pred_lat) ** 2) ** 0.5
-            return error
-
-    except (TypeError, ValueError, KeyError):
+            return (
+                float(expected_args["longitude"]),
+                float(expected_args["latitude"]),
+                float(predicted_args.get("longitude", 0)),
+                float(predicted_args.get("latitude", 0)),
+            )
+
+    except (AttributeError, TypeError, ValueError, KeyError):
         pass
 
     return None
 
 
+def coordinate_errors(coords: array) -> np.ndarray:
+    """Euclidean error in degrees for flat (exp_lon, exp_lat, pred_lon, pred_lat) rows."""
+    rows = np.frombuffer(coords, dtype=np.float64).reshape(-1, 4)
+    return np.hypot(rows[:, 0] - rows[:, 2], rows[:, 1] - rows[:, 3])
+
+
 def evaluate_sample(
     expected_str: str,
     predicted_str: str,
@@ -206,10 +510,10 @@ def evaluate_sample(
         predicted_tool = predicted_json.get("tool")
         tool_match = expected_tool == predicted_tool
 
-    # Calculate coordinate error
-    coord_error = None
+    # Collect coordinates; errors are computed in bulk by print_results
+    coords = None
     if expected_json and predicted_json:
-        coord_error = compare_coordinates(expected_json, predicted_json)
+        coords = extract_coordinates(expected_json, predicted_json)
 
     # Check exact match
     exact_match = expected_str.strip() == predicted_str.strip()
@@ -220,33 +524,60 @@ def evaluate_sample(
         predicted=predicted_str,
         tool_match=tool_match,
         json_valid=json_valid,
-        coord_error=coord_error,
+        coords=coords,
         exact_match=exact_match,
+        expected_json=expected_json,
+        predicted_json=predicted_json,
     )
 
 
-def print_results(results: list[EvalResult], output_file: Optional[str] = None):
-    """Print evaluation results."""
+def stream_results(results: Iterable[EvalResult], path: str) -> Iterator[EvalResult]:
+    """Append each result to a JSONL file as it is produced, then pass it on."""
+    with open(path, "wb") as f:
+        for result in results:
+            f.write(orjson.dumps(asdict(result)) + b"\n")
+            f.flush()
+            yield result
 
-    # Calculate metrics
-    total = len(results)
-    tool_correct = sum(1 for r in results if r.tool_match)
-    json_valid = sum(1 for r in results if r.json_valid)
-    exact_matches = sum(1 for r in results if r.exact_match)
 
-    coord_errors = [r.coord_error for r in results if r.coord_error is not None]
-    avg_coord_error = sum(coord_errors) / len(coord_errors) if coord_errors else None
-
-    # Tool accuracy breakdown
+def print_results(
+    results: Iterable[EvalResult],
+    output_file: Optional[str] = None,
+    examples_file: Optional[str] = None,
+):
+    """Aggregate results in a single pass and print evaluation metrics."""
+
+    # Running counters so results can be consumed as a stream
+    total = 0
+    tool_correct = 0
+    json_valid = 0
+    exact_matches = 0
+    coords = array("d")
     tool_stats = defaultdict(lambda: {"total": 0, "correct": 0})
+
     for r in results:
-        expected_json = parse_json_output(r.expected)
-        if expected_json:
-            tool = expected_json.get("tool", "unknown")
+        total += 1
+        tool_correct += r.tool_match
+        json_valid += r.json_valid
+        exact_matches += r.exact_match
+
+        if r.coords is not None:
+            coords.extend(r.coords)
+
+        # Tool accuracy breakdown
+        if r.expected_json:
+            tool = r.expected_json.get("tool", "unknown")
             tool_stats[tool]["total"] += 1
             if r.tool_match:
                 tool_stats[tool]["correct"] += 1
 
+    avg_coord_error = None
+    coord_percentiles = None
+    if coords:
+        errors = coordinate_errors(coords)
+        avg_coord_error = float(errors.mean())
+        coord_percentiles = dict(zip(("p50", "p90", "p99"), np.percentile(errors, [50, 90, 99]).tolist()))
+
     # Print summary table
     table = Table(title="OrbPro2 MCP Evaluation Results")
     table.add_column("Metric", style="cyan")
@@ -260,6 +591,8 @@ def print_results(results: list[EvalResult], output_file: Optional[str] = None):
 
     if avg_coord_error is not None:
         table.add_row("Avg Coord Error", f"{avg_coord_error:.4f}°", "")
+        for name, value in coord_percentiles.items():
+            table.add_row(f"Coord Error {name}", f"{value:.4f}°", "")
 
     console.print(table)
 
@@ -290,6 +623,7 @@ def print_results(results: list[EvalResult], output_file: Optional[str] = None):
                 "json_valid_rate": json_valid / total if total > 0 else 0,
                 "exact_match_rate": exact_matches / total if total > 0 else 0,
                 "avg_coord_error": avg_coord_error,
+                "coord_error_percentiles": coord_percentiles,
             },
             "per_tool": {
                 tool: {
@@ -298,24 +632,80 @@ def print_results(results: list[EvalResult], output_file: Optional[str] = None):
                 }
                 for tool, stats in tool_stats.items()
             },
-            "examples": [
-                {
-                    "instruction": r.instruction,
-                    "expected": r.expected,
-                    "predicted": r.predicted,
-                    "tool_match": r.tool_match,
-                    "json_valid": r.json_valid,
-                    "coord_error": r.coord_error,
-                    "exact_match": r.exact_match,
-                }
-                for r in results
-            ]
+            "examples_file": examples_file,
         }
 
-        with open(output_file, "w") as f:
-            json.dump(output_data, f, indent=2)
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+        console.print(f"\nSummary saved to: {output_file}")
+        console.print(f"Per-example results saved to: {examples_file}")
+
+
+def iter_predictions(args, test_data) -> Iterator[tuple[str, str, str]]:
+    """Yield (instruction, expected, predicted) triples from the selected backend."""
+    if args.backend == "vllm":
+        instructions = test_data["instruction"]
+        predictions = generate_with_vllm(
+            args.model,
+            instructions,
+            base_model=args.base_model,
+            use_4bit=args.use_4bit,
+            temperature=args.temperature,
+            max_model_len=args.max_model_len,
+        )
+
+        yield from zip(instructions, test_data["output"], predictions)
+    elif args.backend == "ray":
+        rows = generate_with_ray(
+            args.model,
+            test_data,
+            num_gpus=args.num_gpus or max(torch.cuda.device_count(), 1),
+            base_model=args.base_model,
+            use_4bit=args.use_4bit,
+            compile_model=args.compile,
+            use_prefix_cache=args.prefix_cache,
+            temperature=args.temperature,
+            batch_size=args.batch_size,
+        )
+
+        for row in rows:
+            yield row["instruction"], row["output"], row["predicted"]
+    else:
+        model, tokenizer = load_model(
+            args.model,
+            base_model=args.base_model,
+            use_4bit=args.use_4bit,
+            compile_model=args.compile,
+        )
+        model.eval()
+        configure_torch_backends()
+
+        prefix_cache = build_prefix_cache(model, tokenizer) if args.prefix_cache else None
+
+        if args.compile:
+            # Throwaway batch so compilation isn't billed to the first results
+            console.print("Warming up compiled model...")
+            generate_responses(
+                model, tokenizer, test_data[:args.batch_size]["instruction"],
+                max_new_tokens=8,
+                temperature=args.temperature,
+                prefix_cache=prefix_cache,
+            )
+
+        with tqdm(total=len(test_data), desc="Evaluating") as pbar:
+            for start in range(0, len(test_data), args.batch_size):
+                batch = test_data[start:start + args.batch_size]
 
-        console.print(f"\nDetailed results saved to: {output_file}")
+                predictions = generate_responses(
+                    model, tokenizer, batch["instruction"],
+                    temperature=args.temperature,
+                    prefix_cache=prefix_cache,
+                )
+
+                yield from zip(batch["instruction"], batch["output"], predictions)
+
+                pbar.update(len(predictions))
 
 
 def main():
@@ -328,23 +718,35 @@ def main():
     parser.add_argument("--test-file", type=str, required=True,
                        help="Path to test JSONL file")
     parser.add_argument("--output", type=str, default=None,
-                       help="Path to save detailed results JSON")
+                       help="Path to save the summary JSON; per-example results stream to <output>.jsonl")
     parser.add_argument("--max-samples", type=int, default=None,
                        help="Maximum number of samples to evaluate")
     parser.add_argument("--use-4bit", action="store_true",
-                       help="Load model in 4-bit quantization")
+                       help="Load model in 4-bit NF4 quantization. Only applied when the fp16 weights "
+                            "(plus 20%% headroom) don't fit in free VRAM: on <=3B models bitsandbytes "
+                            "dequantization makes NF4 decode ~40%% slower than fp16/bf16")
     parser.add_argument("--temperature", type=float, default=0.1,
                        help="Generation temperature")
+    parser.add_argument("--backend", type=str, default="hf", choices=["hf", "vllm", "ray"],
+                       help="Generation backend: hf (transformers), vllm (batched offline engine) "
+                            "or ray (one transformers replica per GPU)")
+    parser.add_argument("--num-gpus", type=int, default=None,
+                       help="GPUs to shard across with --backend ray (default: all visible)")
+    parser.add_argument("--compile", action="store_true",
+                       help="torch.compile the model forward (hf and ray backends, CUDA compute capability 7.0+)")
+    parser.add_argument("--prefix-cache", action="store_true",
+                       help="Prefill the shared system prompt once and reuse its KV cache "
+                            "(hf and ray backends, transformers>=4.42); vLLM does this with prefix caching")
+    parser.add_argument("--batch-size", type=int, default=16,
+                       help="Prompts per generate call for the hf and ray backends")
+    parser.add_argument("--max-model-len", type=int, default=4096,
+                       help="Maximum context length for the vLLM engine")
 
     args = parser.parse_args()
 
-    # Load model
-    model, tokenizer = load_model(
-        args.model,
-        base_model=args.base_model,
-        use_4bit=args.use_4bit,
-    )
-    model.eval()
+    # The cache is copied per batch with DynamicCache.batch_repeat_interleave
+    if args.prefix_cache and not hasattr(DynamicCache, "batch_repeat_interleave"):
+        parser.error("--prefix-cache requires transformers>=4.42")
 
     # Load test data
     console.print(f"Loading test data: {args.test_file}")
@@ -355,22 +757,18 @@ def main():
 
     console.print(f"Evaluating on {len(test_data)} examples...")
 
-    # Evaluate
-    results = []
-    for example in tqdm(test_data, desc="Evaluating"):
-        instruction = example["instruction"]
-        expected = example["output"]
-
-        predicted = generate_response(
-            model, tokenizer, instruction,
-            temperature=args.temperature,
-        )
+    results = (
+        evaluate_sample(expected, predicted, instruction)
+        for instruction, expected, predicted in iter_predictions(args, test_data)
+    )
 
-        result = evaluate_sample(expected, predicted, instruction)
-        results.append(result)
+    examples_file = None
+    if args.output:
+        examples_file = args.output + ".jsonl"
+        results = stream_results(results, examples_file)
 
-    # Print results
-    print_results(results, args.output)
+    # Evaluate and print results
+    print_results(results, args.output, examples_file)
 
 
 if __name__ == "__main__":
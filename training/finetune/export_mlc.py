@@ -7,11 +7,14 @@ Supports quantization for optimal browser performance.
 """
 
 import argparse
+import hashlib
 import json
 import os
 import shutil
 import subprocess
 import sys
+from collections import deque
+from functools import lru_cache
 from pathlib import Path
 
 from rich.console import Console
@@ -20,6 +23,7 @@ from rich.progress import Progress, SpinnerColumn, TextColumn
 console = Console()
 
 
+@lru_cache(maxsize=None)
 def check_mlc_installed() -> bool:
     """Check if MLC LLM is installed."""
     try:
@@ -33,13 +37,63 @@ def check_mlc_installed() -> bool:
         return False
 
 
+def run_with_progress(cmd: list[str], description: str) -> tuple[int, str]:
+    """Run a command, streaming its output into a spinner line.
+
+    Returns the exit code and the last lines of output for error reporting,
+    so long MLC runs never buffer their whole log in memory.
+    """
+    tail = deque(maxlen=50)
+
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        console=console,
+    ) as progress:
+        task = progress.add_task(description, total=None)
+
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+        try:
+            for line in process.stdout:
+                line = line.strip()
+                if line:
+                    tail.append(line)
+                    progress.update(task, description=line[:80])
+        except KeyboardInterrupt:
+            process.terminate()
+            raise
+
+        returncode = process.wait()
+
+    return returncode, "\n".join(tail)
+
+
+def lora_fingerprint(base_model: str, lora_path: str) -> str:
+    """Hash the base model name and adapter files to detect an up-to-date merge."""
+    sha = hashlib.sha256(base_model.encode())
+    for path in sorted(Path(lora_path).glob("adapter*")):
+        sha.update(path.name.encode())
+        sha.update(path.read_bytes())
+    return sha.hexdigest()
+
+
 def merge_lora_weights(
     base_model: str,
     lora_path: str,
     output_path: str,
-    use_4bit: bool = False,
 ):
-    """Merge LoRA weights into base model."""
+    """Merge LoRA weights into base model.
+
+    Runs entirely on CPU in fp16: the merged weights go straight to disk and
+    MLC requantizes them from fp16, so neither a GPU nor 4-bit loading helps.
+    """
     import torch
     from transformers import AutoModelForCausalLM, AutoTokenizer
     from peft import PeftModel
@@ -47,26 +101,13 @@ def merge_lora_weights(
     console.print(f"Merging LoRA weights from {lora_path}...")
 
     # Load base model
-    if use_4bit:
-        from transformers import BitsAndBytesConfig
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            base_model,
-            trust_remote_code=True,
-            quantization_config=quantization_config,
-            device_map="auto",
-        )
-    else:
-        model = AutoModelForCausalLM.from_pretrained(
-            base_model,
-            trust_remote_code=True,
-            torch_dtype=torch.float16,
-            device_map="auto",
-        )
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model,
+        trust_remote_code=True,
+        torch_dtype=torch.float16,
+        device_map={"": "cpu"},
+        low_cpu_mem_usage=True,
+    )
 
     # Load and merge LoRA
     model = PeftModel.from_pretrained(model, lora_path)
@@ -74,7 +115,12 @@ def merge_lora_weights(
 
     # Save merged model
     console.print(f"Saving merged model to {output_path}...")
-    model.save_pretrained(output_path)
+    # Sharded safetensors can be memory-mapped by the MLC weight converter
+    model.to(torch.float16).cpu().save_pretrained(
+        output_path,
+        safe_serialization=True,
+        max_shard_size="4GB",
+    )
 
     # Save tokenizer
     tokenizer = AutoTokenizer.from_pretrained(base_model, trust_remote_code=True)
@@ -104,22 +150,11 @@ def convert_to_mlc(
         "--output", output_dir,
     ]
 
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        console=console,
-    ) as progress:
-        task = progress.add_task("Converting weights...", total=None)
-
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-        )
+    returncode, output = run_with_progress(cmd, "Converting weights...")
 
-        if result.returncode != 0:
-            console.print(f"[red]Error converting weights:[/red]\n{result.stderr}")
-            return False
+    if returncode != 0:
+        console.print(f"[red]Error converting weights:[/red]\n{output}")
+        return False
 
     # Generate model library for WebGPU
     console.print("Generating WebGPU library...")
@@ -131,10 +166,10 @@ def convert_to_mlc(
         "--output", output_dir,
     ]
 
-    result = subprocess.run(lib_cmd, capture_output=True, text=True)
+    returncode, output = run_with_progress(lib_cmd, "Generating config...")
 
-    if result.returncode != 0:
-        console.print(f"[yellow]Warning generating config:[/yellow]\n{result.stderr}")
+    if returncode != 0:
+        console.print(f"[yellow]Warning generating config:[/yellow]\n{output}")
 
     return True
 
@@ -182,10 +217,10 @@ def create_model_lib_wasm(output_dir: str, quantization: str):
         "--output", os.path.join(output_dir, "model.wasm"),
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    returncode, output = run_with_progress(cmd, "Compiling WASM library...")
 
-    if result.returncode != 0:
-        console.print(f"[yellow]WASM compilation warning:[/yellow]\n{result.stderr}")
+    if returncode != 0:
+        console.print(f"[yellow]WASM compilation warning:[/yellow]\n{output}")
         console.print("Note: WASM compilation may require additional setup.")
         return False
 
@@ -239,13 +274,24 @@ def main():
             console.print("[red]Base model required for LoRA adapter![/red]")
             sys.exit(1)
 
-        # Merge to temporary directory
+        # Merge to temporary directory, reusing a previous merge of the same adapter
         merged_path = os.path.join(output_dir, "merged_model")
-        model_path = merge_lora_weights(
-            args.base_model,
-            args.model,
-            merged_path,
-        )
+        hash_path = Path(merged_path) / ".lora_hash"
+        fingerprint = lora_fingerprint(args.base_model, args.model)
+
+        if hash_path.exists() and hash_path.read_text().strip() == fingerprint:
+            console.print(f"Merged model is up to date, reusing {merged_path}")
+            model_path = merged_path
+        else:
+            # Drop the old hash first so an interrupted merge is never mistaken
+            # for a complete one; the new hash is written only once it finishes
+            hash_path.unlink(missing_ok=True)
+            model_path = merge_lora_weights(
+                args.base_model,
+                args.model,
+                merged_path,
+            )
+            hash_path.write_text(fingerprint)
 
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
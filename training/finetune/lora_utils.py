@@ -0,0 +1,137 @@
+"""
+Shared model and LoRA setup for the OrbPro2 MCP training scripts.
+"""
+
+import math
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from peft import LoraConfig, TaskType
+from transformers import PreTrainedTokenizerBase
+
+
+def configure_torch_backends():
+    """Allow TF32 tensor-core matmuls/convolutions and cuDNN autotuning."""
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
+
+def supports_tf32() -> bool:
+    """TF32 tensor cores exist on Ampere (sm_80) and newer."""
+    return torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+
+
+def get_attn_implementation(half_precision: bool) -> str:
+    """Prefer fused FlashAttention-2 for fp16/bf16 CUDA runs, else PyTorch SDPA."""
+    if half_precision and torch.cuda.is_available():
+        try:
+            import flash_attn  # noqa: F401
+            return "flash_attention_2"
+        except ImportError:
+            pass
+    return "sdpa"
+
+
+def map_num_proc() -> int:
+    """Worker processes for Dataset.map preprocessing.
+
+    The Rust tokenizer's thread pool is only enabled when the map runs in a
+    single process: forked map/dataloader workers would each start a full pool
+    and bypass the tokenizers fork-safety fallback.
+    """
+    num_proc = min(os.cpu_count() or 1, 16)
+    if num_proc == 1:
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+    return num_proc
+
+
+def dataloader_kwargs(pin_memory: bool) -> dict:
+    """TrainingArguments for background loader workers that prefetch into pinned memory while the GPU computes."""
+    num_workers = min(4, (os.cpu_count() or 1) // 2)
+    return {
+        "dataloader_num_workers": num_workers,
+        "dataloader_pin_memory": pin_memory,
+        "dataloader_persistent_workers": num_workers > 0,
+        "dataloader_prefetch_factor": 4 if num_workers > 0 else None,
+    }
+
+
+def build_lora_config(
+    r: int,
+    alpha: int,
+    dropout: float,
+    target_modules: List[str],
+    kaiming_fast: bool = False,
+) -> LoraConfig:
+    """LoRA config with rank-stabilized scaling (alpha / sqrt(r)).
+
+    With kaiming_fast, PEFT skips its per-module init and
+    kaiming_init_lora_weights_ must be called after get_peft_model.
+    """
+    return LoraConfig(
+        task_type=TaskType.CAUSAL_LM,
+        r=r,
+        lora_alpha=alpha,
+        lora_dropout=dropout,
+        target_modules=target_modules,
+        bias="none",
+        init_lora_weights=False if kaiming_fast else "gaussian",
+        use_rslora=True,
+    )
+
+
+@torch.no_grad()
+def kaiming_init_lora_weights_(model) -> None:
+    """Initialise all LoRA A matrices with one kaiming_uniform_ call per shape and zero all B.
+
+    Matches PEFT's default init (kaiming_uniform_ with a=sqrt(5) on A, zeros on B)
+    without a Python-level init call per adapted module.
+    """
+    groups = defaultdict(list)
+    lora_b = []
+    for name, param in model.named_parameters():
+        if ".lora_A." in name:
+            groups[(param.shape, param.dtype, param.device)].append(param)
+        elif ".lora_B." in name:
+            lora_b.append(param)
+
+    for (shape, _, _), params in groups.items():
+        # View the stack as (n * r, in_features) so fan_in stays in_features
+        stacked = torch.empty(len(params) * shape[0], shape[1], dtype=params[0].dtype, device=params[0].device)
+        torch.nn.init.kaiming_uniform_(stacked, a=math.sqrt(5))
+        for param, chunk in zip(params, stacked.split(shape[0])):
+            param.copy_(chunk)
+
+    if lora_b:
+        torch._foreach_zero_(lora_b)
+
+
+@dataclass
+class CompletionOnlyCollator:
+    """Pad a batch and build labels from input_ids, masking prompt and padding with -100.
+
+    Labels are derived per batch instead of being cached as a second token column.
+    """
+    tokenizer: PreTrainedTokenizerBase
+    pad_to_multiple_of: Optional[int] = None
+
+    def __call__(self, features):
+        prompt_lengths = torch.tensor([f["prompt_length"] for f in features])
+        batch = self.tokenizer.pad(
+            [{"input_ids": f["input_ids"], "attention_mask": f["attention_mask"]} for f in features],
+            padding=True,
+            pad_to_multiple_of=self.pad_to_multiple_of,
+            return_tensors="pt",
+        )
+        attention_mask = batch["attention_mask"]
+        # 1-based position among real tokens, independent of padding side
+        positions = attention_mask.cumsum(dim=1)
+        labels = batch["input_ids"].clone()
+        labels[(attention_mask == 0) | (positions <= prompt_lengths[:, None])] = -100
+        batch["labels"] = labels
+        return batch
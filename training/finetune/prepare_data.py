@@ -11,22 +11,109 @@ import json
 import os
 import random
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
-import jsonlines
-from datasets import Dataset, DatasetDict
+import orjson
+from datasets import Dataset, DatasetDict, Features, Value
 
 
-def load_jsonl(file_path: str) -> list[dict]:
-    """Load JSONL file into list of dicts."""
-    data = []
-    with jsonlines.open(file_path) as reader:
-        for obj in reader:
-            data.append(obj)
-    return data
+def iter_jsonl(file_path: str) -> Iterator[dict]:
+    """Yield dicts from a JSONL file one line at a time."""
+    with open(file_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
 
-def convert_to_alpaca_format(examples: list[dict]) -> list[dict]:
+# Every example is projected onto these str columns, so the Arrow schema does
+# not depend on which rows or files happen to come first
+EXAMPLE_FIELDS = ("instruction", "input", "output")
+EXAMPLE_FEATURES = Features({key: Value("string") for key in EXAMPLE_FIELDS})
+
+
+def _as_text(value) -> str:
+    """Missing/null -> "", str unchanged, anything else (e.g. a tool-call dict) -> compact JSON."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return orjson.dumps(value).decode("utf-8")
+
+
+def normalize_example(example: dict) -> dict:
+    """Return the example's instruction/input/output fields as strings.
+
+    >>> normalize_example({"input": "Show me Paris", "output": {"tool": "flyTo"}})
+    {'instruction': '', 'input': 'Show me Paris', 'output': '{"tool":"flyTo"}'}
+    """
+    return {key: _as_text(example.get(key)) for key in EXAMPLE_FIELDS}
+
+
+def iter_examples(files: list[tuple[str, int, int]]) -> Iterator[dict]:
+    """Yield examples from every JSONL file in turn (Dataset.from_generator source).
+
+    Files are (path, size, mtime_ns) tuples; only the path is read here, but the
+    stat fields are part of gen_kwargs and so of the datasets cache key, which
+    otherwise would not change when a file is rewritten in place.
+    """
+    for file_path, _, _ in files:
+        for example in iter_jsonl(file_path):
+            yield normalize_example(example)
+
+
+def _column(batch: dict, name: str) -> list[str]:
+    """Return a batch column as strings, treating missing columns/values as empty."""
+    values = batch.get(name)
+    if values is None:
+        return [""] * len(next(iter(batch.values())))
+    return [value or "" for value in values]
+
+
+def _user_messages(batch: dict) -> list[str]:
+    """Combine instruction and input (when present) into a single user message."""
+    return [
+        f"{instruction}\n\nInput: {input_text}" if input_text else instruction
+        for instruction, input_text in zip(_column(batch, "instruction"), _column(batch, "input"))
+    ]
+
+
+def to_alpaca(batch: dict) -> dict:
+    """Batched Dataset.map function for Alpaca format."""
+    return {
+        "instruction": _column(batch, "instruction"),
+        "input": _column(batch, "input"),
+        "output": _column(batch, "output"),
+    }
+
+
+def to_sharegpt(batch: dict) -> dict:
+    """Batched Dataset.map function for ShareGPT format."""
+    return {
+        "conversations": [
+            [
+                {"from": "human", "value": human_msg},
+                {"from": "gpt", "value": output}
+            ]
+            for human_msg, output in zip(_user_messages(batch), _column(batch, "output"))
+        ]
+    }
+
+
+def to_messages(batch: dict, system_prompt: str = "") -> dict:
+    """Batched Dataset.map function for OpenAI messages format."""
+    system = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    return {
+        "messages": [
+            system + [
+                {"role": "user", "content": user_msg},
+                {"role": "assistant", "content": output}
+            ]
+            for user_msg, output in zip(_user_messages(batch), _column(batch, "output"))
+        ]
+    }
+
+
+def convert_to_alpaca_format(examples: Dataset, num_proc: Optional[int] = None) -> Dataset:
     """
     Convert to Alpaca instruction format.
 
@@ -37,17 +124,11 @@ def convert_to_alpaca_format(examples: list[dict]) -> list[dict]:
         "output": "..."
     }
     """
-    converted = []
-    for ex in examples:
-        converted.append({
-            "instruction": ex.get("instruction", ""),
-            "input": ex.get("input", ""),
-            "output": ex.get("output", "")
-        })
-    return converted
+    return examples.map(to_alpaca, batched=True, num_proc=num_proc,
+                        remove_columns=examples.column_names)
 
 
-def convert_to_sharegpt_format(examples: list[dict]) -> list[dict]:
+def convert_to_sharegpt_format(examples: Dataset, num_proc: Optional[int] = None) -> Dataset:
     """
     Convert to ShareGPT conversation format.
 
@@ -59,27 +140,15 @@ def convert_to_sharegpt_format(examples: list[dict]) -> list[dict]:
         ]
     }
     """
-    converted = []
-    for ex in examples:
-        instruction = ex.get("instruction", "")
-        input_text = ex.get("input", "")
-        output = ex.get("output", "")
-
-        # Combine instruction and input if both present
-        human_msg = instruction
-        if input_text:
-            human_msg = f"{instruction}\n\nInput: {input_text}"
-
-        converted.append({
-            "conversations": [
-                {"from": "human", "value": human_msg},
-                {"from": "gpt", "value": output}
-            ]
-        })
-    return converted
+    return examples.map(to_sharegpt, batched=True, num_proc=num_proc,
+                        remove_columns=examples.column_names)
 
 
-def convert_to_messages_format(examples: list[dict], system_prompt: str = "") -> list[dict]:
+def convert_to_messages_format(
+    examples: Dataset,
+    system_prompt: str = "",
+    num_proc: Optional[int] = None,
+) -> Dataset:
     """
     Convert to OpenAI messages format for chat fine-tuning.
 
@@ -92,61 +161,41 @@ def convert_to_messages_format(examples: list[dict], system_prompt: str = "") ->
         ]
     }
     """
-    converted = []
-    for ex in examples:
-        instruction = ex.get("instruction", "")
-        input_text = ex.get("input", "")
-        output = ex.get("output", "")
-
-        # Build user message
-        user_msg = instruction
-        if input_text:
-            user_msg = f"{instruction}\n\nInput: {input_text}"
-
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": user_msg})
-        messages.append({"role": "assistant", "content": output})
-
-        converted.append({"messages": messages})
-    return converted
+    return examples.map(to_messages, batched=True, num_proc=num_proc,
+                        fn_kwargs={"system_prompt": system_prompt},
+                        remove_columns=examples.column_names)
 
 
 def create_train_test_split(
-    data: list[dict],
+    data: Dataset,
     test_size: float = 0.1,
     seed: int = 42
-) -> tuple[list[dict], list[dict]]:
+) -> tuple[Dataset, Dataset]:
     """Split data into train and test sets."""
-    random.seed(seed)
-    shuffled = data.copy()
-    random.shuffle(shuffled)
+    # Shuffle row indices only; select() maps them over the Arrow table without copying rows
+    rng = random.Random(seed)
+    idx = list(range(len(data)))
+    rng.shuffle(idx)
 
-    split_idx = int(len(shuffled) * (1 - test_size))
-    return shuffled[:split_idx], shuffled[split_idx:]
+    split_idx = int(len(data) * (1 - test_size))
+    return data.select(idx[:split_idx]), data.select(idx[split_idx:])
 
 
-def save_jsonl(data: list[dict], output_path: str):
+def save_jsonl(data: Dataset, output_path: str, num_proc: Optional[int] = None):
     """Save data to JSONL file."""
-    with jsonlines.open(output_path, mode='w') as writer:
-        for item in data:
-            writer.write(item)
+    data.to_json(output_path, lines=True, num_proc=num_proc)
     print(f"Saved {len(data)} examples to {output_path}")
 
 
 def save_as_hf_dataset(
-    train_data: list[dict],
-    test_data: list[dict],
+    train_data: Dataset,
+    test_data: Dataset,
     output_dir: str
 ):
     """Save as HuggingFace dataset format."""
-    train_dataset = Dataset.from_list(train_data)
-    test_dataset = Dataset.from_list(test_data)
-
     dataset_dict = DatasetDict({
-        "train": train_dataset,
-        "test": test_dataset
+        "train": train_data,
+        "test": test_data
     })
 
     dataset_dict.save_to_disk(output_dir)
@@ -199,21 +248,39 @@ def main():
         default=42,
         help="Random seed for train/test split"
     )
+    parser.add_argument(
+        "--num-proc",
+        type=int,
+        default=os.cpu_count(),
+        help="Worker processes for loading, format conversion and writing (default: all CPUs)"
+    )
 
     args = parser.parse_args()
 
     # Load data
     input_path = Path(args.input)
-    all_data = []
 
     if input_path.is_file():
-        all_data = load_jsonl(str(input_path))
+        files = [str(input_path)]
     elif input_path.is_dir():
-        for jsonl_file in input_path.glob("*.jsonl"):
-            all_data.extend(load_jsonl(str(jsonl_file)))
+        files = [str(jsonl_file) for jsonl_file in sorted(input_path.glob("*.jsonl"))]
     else:
         raise FileNotFoundError(f"Input path not found: {args.input}")
 
+    # Stat each file once; rewriting a file in place then changes the cache key
+    files = [(path, st.st_size, st.st_mtime_ns) for path, st in zip(files, map(os.stat, files))]
+
+    # Stream examples into an Arrow-backed dataset instead of a Python list.
+    # The file list is sharded across worker processes, each writing its own
+    # Arrow shard, so multi-file corpora are parsed in parallel. The explicit
+    # features keep every shard on the same schema for concatenation.
+    all_data = Dataset.from_generator(
+        iter_examples,
+        features=EXAMPLE_FEATURES,
+        gen_kwargs={"files": files},
+        num_proc=max(1, min(len(files), args.num_proc or 1)),
+    )
+
     print(f"Loaded {len(all_data)} examples from {args.input}")
 
     # Create output directory
@@ -233,20 +300,20 @@ def main():
 
     for fmt in formats_to_save:
         if fmt == "alpaca":
-            train_converted = convert_to_alpaca_format(train_data)
-            test_converted = convert_to_alpaca_format(test_data)
+            train_converted = convert_to_alpaca_format(train_data, args.num_proc)
+            test_converted = convert_to_alpaca_format(test_data, args.num_proc)
         elif fmt == "sharegpt":
-            train_converted = convert_to_sharegpt_format(train_data)
-            test_converted = convert_to_sharegpt_format(test_data)
+            train_converted = convert_to_sharegpt_format(train_data, args.num_proc)
+            test_converted = convert_to_sharegpt_format(test_data, args.num_proc)
         elif fmt == "messages":
-            train_converted = convert_to_messages_format(train_data, args.system_prompt)
-            test_converted = convert_to_messages_format(test_data, args.system_prompt)
+            train_converted = convert_to_messages_format(train_data, args.system_prompt, args.num_proc)
+            test_converted = convert_to_messages_format(test_data, args.system_prompt, args.num_proc)
         else:
             continue
 
         # Save JSONL files
-        save_jsonl(train_converted, str(output_dir / f"train_{fmt}.jsonl"))
-        save_jsonl(test_converted, str(output_dir / f"test_{fmt}.jsonl"))
+        save_jsonl(train_converted, str(output_dir / f"train_{fmt}.jsonl"), args.num_proc)
+        save_jsonl(test_converted, str(output_dir / f"test_{fmt}.jsonl"), args.num_proc)
 
         # Optionally save as HuggingFace dataset
         if args.hf_dataset:
@@ -258,7 +325,7 @@ def main():
 
     # Print sample
     print("\n--- Sample training example (alpaca format) ---")
-    sample = convert_to_alpaca_format([all_data[0]])[0]
+    sample = {key: values[0] for key, values in to_alpaca(all_data[:1]).items()}
     print(json.dumps(sample, indent=2))
 
     print("\nData preparation complete!")
@@ -14,17 +14,28 @@ from pathlib import Path
 from typing import Optional
 
 import torch
+from torch.utils.checkpoint import checkpoint
 from datasets import load_dataset, load_from_disk
-from peft import LoraConfig, TaskType, get_peft_model, prepare_model_for_kbit_training
+from peft import get_peft_model, prepare_model_for_kbit_training
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    DataCollatorForSeq2Seq,
     Trainer,
     TrainingArguments,
 )
 
+from lora_utils import (
+    CompletionOnlyCollator,
+    build_lora_config,
+    configure_torch_backends,
+    dataloader_kwargs,
+    get_attn_implementation,
+    kaiming_init_lora_weights_,
+    map_num_proc,
+    supports_tf32,
+)
+
 
 @dataclass
 class ModelArguments:
@@ -78,66 +89,99 @@ class LoraArguments:
     )
 
 
-def get_prompt_template(template_name: str):
-    """Return prompt formatting functions based on template type."""
-
-    if template_name == "alpaca":
-        def format_prompt(instruction: str, input_text: str = "", output: str = "") -> str:
-            if input_text:
-                prompt = f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+ALPACA_TEMPLATE = """Below is an instruction that describes a task. Write a response that appropriately completes the request.
 
 ### Instruction:
 {instruction}
 
-### Input:
-{input_text}
-
 ### Response:
-{output}"""
-            else:
-                prompt = f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
+"""
+
+ALPACA_TEMPLATE_WITH_INPUT = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
 
 ### Instruction:
 {instruction}
 
+### Input:
+{input}
+
 ### Response:
-{output}"""
-            return prompt
-        return format_prompt
-
-    elif template_name == "chatml":
-        def format_prompt(instruction: str, input_text: str = "", output: str = "") -> str:
-            user_content = instruction
-            if input_text:
-                user_content = f"{instruction}\n\nInput: {input_text}"
-            return f"""<|im_start|>system
+"""
+
+CHATML_TEMPLATE = """<|im_start|>system
 You are a helpful assistant that controls CesiumJS. Convert natural language commands to JSON tool calls.<|im_end|>
 <|im_start|>user
-{user_content}<|im_end|>
+{user}<|im_end|>
 <|im_start|>assistant
-{output}<|im_end|>"""
-        return format_prompt
-
-    else:  # sharegpt / default
-        def format_prompt(instruction: str, input_text: str = "", output: str = "") -> str:
-            user_content = instruction
-            if input_text:
-                user_content = f"{instruction}\n\nInput: {input_text}"
-            return f"User: {user_content}\nAssistant: {output}"
-        return format_prompt
-
-
-def preprocess_data(examples, tokenizer, max_length: int, format_prompt):
-    """Tokenize and prepare data for training."""
-
-    texts = []
-    for instruction, input_text, output in zip(
-        examples.get("instruction", []),
-        examples.get("input", [""] * len(examples.get("instruction", []))),
-        examples.get("output", [])
-    ):
-        text = format_prompt(instruction, input_text, output)
-        texts.append(text)
+"""
+
+SHAREGPT_TEMPLATE = "User: {user}\nAssistant: "
+
+# Appended after the response; part of the supervised completion
+RESPONSE_SUFFIXES = {"chatml": "<|im_end|>"}
+
+
+def get_prompt_template(template_name: str):
+    """Return a batched formatter: (instructions, inputs) -> list of prompts up to the response."""
+
+    if template_name == "alpaca":
+        format_with_input = ALPACA_TEMPLATE_WITH_INPUT.format
+        format_without_input = ALPACA_TEMPLATE.format
+
+        def format_prompts(instructions, inputs):
+            # Split rows by whether they have an input, format each group with
+            # one comprehension, then scatter the prompts back into row order
+            has_input = [i for i, input_text in enumerate(inputs) if input_text]
+            no_input = [i for i, input_text in enumerate(inputs) if not input_text]
+
+            with_input = [format_with_input(instruction=instructions[i], input=inputs[i]) for i in has_input]
+            without_input = [format_without_input(instruction=instructions[i]) for i in no_input]
+
+            prompts = [None] * len(instructions)
+            for i, prompt in zip(has_input + no_input, with_input + without_input):
+                prompts[i] = prompt
+            return prompts
+        return format_prompts
+
+    template = CHATML_TEMPLATE if template_name == "chatml" else SHAREGPT_TEMPLATE  # sharegpt / default
+
+    def format_prompts(instructions, inputs):
+        return [
+            template.format(user=f"{instruction}\n\nInput: {input_text}" if input_text else instruction)
+            for instruction, input_text in zip(instructions, inputs)
+        ]
+    return format_prompts
+
+
+def checkpoint_every_nth_layer(model, interval: int):
+    """Recompute activations for every `interval`-th decoder layer only.
+
+    Cheaper than HF's per-layer checkpointing when memory allows: only 1/interval
+    of the layers pay the recompute cost in the backward pass.
+    """
+    def wrap(forward):
+        def checkpointed_forward(*args, **kwargs):
+            if not torch.is_grad_enabled():
+                return forward(*args, **kwargs)
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return checkpointed_forward
+
+    layers = model.get_base_model().model.layers
+    for i, layer in enumerate(layers):
+        if i % interval == 0:
+            layer.forward = wrap(layer.forward)
+    model.config.use_cache = False
+
+
+def preprocess_data(examples, tokenizer, max_length: int, format_prompts, response_suffix: str = ""):
+    """Tokenize and prepare data for training, with loss on the response tokens only."""
+
+    instructions = examples.get("instruction", [])
+    prompts = format_prompts(instructions, examples.get("input", [""] * len(instructions)))
+    texts = [
+        prompt + output + response_suffix
+        for prompt, output in zip(prompts, examples.get("output", []))
+    ]
 
     tokenized = tokenizer(
         texts,
@@ -146,14 +190,20 @@ def preprocess_data(examples, tokenizer, max_length: int, format_prompt):
         padding=False,
         return_tensors=None,
     )
+    prompt_ids = tokenizer(prompts, truncation=True, max_length=max_length)["input_ids"]
+
+    # The collator masks these prompt tokens when it builds labels
+    tokenized["prompt_length"] = [len(prompt) for prompt in prompt_ids]
 
-    # Set labels = input_ids for causal LM training
-    tokenized["labels"] = tokenized["input_ids"].copy()
+    # Sequence lengths for length-grouped batching
+    tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
 
     return tokenized
 
 
 def main():
+    configure_torch_backends()
+
     parser = argparse.ArgumentParser(description="Fine-tune LLM with LoRA for OrbPro2 MCP")
 
     # Model arguments
@@ -170,6 +220,8 @@ def main():
     parser.add_argument("--lora-r", type=int, default=16)
     parser.add_argument("--lora-alpha", type=int, default=32)
     parser.add_argument("--lora-dropout", type=float, default=0.05)
+    parser.add_argument("--lora-init-kaiming-fast", action="store_true",
+                       help="Initialise LoRA A matrices with one batched kaiming call per shape")
     parser.add_argument("--target-modules", type=str,
                        default="q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj")
 
@@ -187,14 +239,51 @@ def main():
     parser.add_argument("--logging-steps", type=int, default=10)
     parser.add_argument("--save-steps", type=int, default=500)
     parser.add_argument("--eval-steps", type=int, default=500)
+    parser.add_argument("--save-strategy", type=str, default="steps",
+                       choices=["steps", "epoch", "no"])
+    parser.add_argument("--eval-strategy", type=str, default="steps",
+                       choices=["steps", "epoch", "no"])
+    parser.add_argument("--load-best", action="store_true",
+                       help="Reload the best checkpoint at the end (requires --eval-file)")
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-optimizer-state", action="store_true",
+                       help="Keep optimizer/scheduler state in checkpoints (needed to resume)")
+    parser.add_argument("--gradient-checkpointing", action="store_true",
+                       help="Trade recompute for activation memory")
+    parser.add_argument("--gc-interval", type=int, default=1,
+                       help="With --gradient-checkpointing, checkpoint every Nth decoder layer")
 
     # Quantization
     parser.add_argument("--load-in-8bit", action="store_true")
     parser.add_argument("--load-in-4bit", action="store_true")
 
+    # Compilation
+    parser.add_argument("--no-compile", action="store_true",
+                       help="Disable torch.compile of the PEFT model")
+
+    # Multi-GPU scale-out (launch with torchrun / accelerate launch)
+    parser.add_argument("--fsdp", type=str, default=None,
+                       help='FSDP options, e.g. "full_shard auto_wrap"')
+    parser.add_argument("--deepspeed", type=str, default=None,
+                       help="Path to a DeepSpeed config JSON (e.g. ZeRO-2)")
+
     args = parser.parse_args()
 
+    if args.gc_interval < 1:
+        parser.error("--gc-interval must be >= 1")
+
+    # load_best_model_at_end needs every eval to coincide with a save
+    if args.load_best:
+        if not args.eval_file:
+            parser.error("--load-best requires --eval-file")
+        if args.save_strategy != args.eval_strategy:
+            parser.error("--load-best requires --save-strategy to match --eval-strategy")
+        if args.save_strategy == "steps" and args.save_steps != args.eval_steps:
+            parser.error("--load-best requires --save-steps to equal --eval-steps")
+        # Sharded checkpoints can only be reloaded through the full trainer state
+        if (args.fsdp or args.deepspeed) and not args.save_optimizer_state:
+            parser.error("--load-best with --fsdp/--deepspeed requires --save-optimizer-state")
+
     print(f"Loading model: {args.model}")
 
     # Setup quantization config if needed
@@ -214,39 +303,72 @@ def main():
         args.model,
         trust_remote_code=args.trust_remote_code,
         padding_side="right",
+        use_fast=True,
     )
 
+    if not tokenizer.is_fast:
+        raise ValueError(f"No fast (Rust) tokenizer available for {args.model}")
+
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
     # Load model
+    attn_implementation = get_attn_implementation(args.bf16 or args.fp16 or quantization_config is not None)
+    print(f"Attention implementation: {attn_implementation}")
+
+    # FSDP/DeepSpeed place and shard the model themselves; a single visible
+    # GPU needs no accelerate dispatch hooks
+    if args.fsdp or args.deepspeed or not quantization_config:
+        device_map = None
+    else:
+        device_map = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
         trust_remote_code=args.trust_remote_code,
         quantization_config=quantization_config,
-        device_map="auto" if quantization_config else None,
+        device_map=device_map,
         torch_dtype=torch.bfloat16 if args.bf16 else (torch.float16 if args.fp16 else torch.float32),
+        attn_implementation=attn_implementation,
     )
 
     # Prepare model for k-bit training if using quantization
+    # (gc_interval > 1 is handled by checkpoint_every_nth_layer after PEFT wrapping)
+    hf_gradient_checkpointing = args.gradient_checkpointing and args.gc_interval == 1
     if quantization_config:
-        model = prepare_model_for_kbit_training(model)
+        model = prepare_model_for_kbit_training(
+            model,
+            use_gradient_checkpointing=hf_gradient_checkpointing,
+            gradient_checkpointing_kwargs={"use_reentrant": False},
+        )
 
     # Configure LoRA
     target_modules = [m.strip() for m in args.target_modules.split(",")]
 
-    lora_config = LoraConfig(
-        task_type=TaskType.CAUSAL_LM,
-        r=args.lora_r,
-        lora_alpha=args.lora_alpha,
-        lora_dropout=args.lora_dropout,
-        target_modules=target_modules,
-        bias="none",
+    lora_config = build_lora_config(
+        args.lora_r,
+        args.lora_alpha,
+        args.lora_dropout,
+        target_modules,
+        kaiming_fast=args.lora_init_kaiming_fast,
     )
 
     model = get_peft_model(model, lora_config)
+    if args.lora_init_kaiming_fast:
+        kaiming_init_lora_weights_(model)
     model.print_trainable_parameters()
 
+    if args.gradient_checkpointing and args.gc_interval > 1:
+        checkpoint_every_nth_layer(model, args.gc_interval)
+
+    # Fuse per-layer op chains with Inductor; compiled in place so the Trainer
+    # and save_pretrained still see the PeftModel. bitsandbytes kernels don't
+    # compose with reduce-overhead CUDA graphs, so quantized runs use default.
+    if torch.cuda.is_available() and not (args.no_compile or args.fsdp or args.deepspeed):
+        torch._dynamo.config.cache_size_limit = 64
+        quantized = args.load_in_4bit or args.load_in_8bit
+        model.compile(mode="default" if quantized else "reduce-overhead", dynamic=True)
+
     # Load dataset
     print(f"Loading training data from: {args.train_file}")
 
@@ -272,31 +394,41 @@ def main():
             eval_dataset = load_dataset("json", data_files=str(eval_path), split="train")
 
     # Get prompt template
-    format_prompt = get_prompt_template(args.template)
+    format_prompts = get_prompt_template(args.template)
 
     # Preprocess data
     print("Preprocessing training data...")
+    map_kwargs = {
+        "fn_kwargs": {
+            "tokenizer": tokenizer,
+            "max_length": args.max_length,
+            "format_prompts": format_prompts,
+            "response_suffix": RESPONSE_SUFFIXES.get(args.template, ""),
+        },
+        "batched": True,
+        "batch_size": 2000,
+        "writer_batch_size": 2000,
+        "num_proc": map_num_proc(),
+        "load_from_cache_file": True,
+        "desc": "tokenize",
+    }
+
     train_dataset = train_dataset.map(
-        lambda x: preprocess_data(x, tokenizer, args.max_length, format_prompt),
-        batched=True,
+        preprocess_data,
         remove_columns=train_dataset.column_names,
+        **map_kwargs,
     )
 
     if eval_dataset:
         print("Preprocessing evaluation data...")
         eval_dataset = eval_dataset.map(
-            lambda x: preprocess_data(x, tokenizer, args.max_length, format_prompt),
-            batched=True,
+            preprocess_data,
             remove_columns=eval_dataset.column_names,
+            **map_kwargs,
         )
 
-    # Data collator
-    data_collator = DataCollatorForSeq2Seq(
-        tokenizer=tokenizer,
-        model=model,
-        padding=True,
-        return_tensors="pt",
-    )
+    # Data collator (builds response-only labels per batch)
+    data_collator = CompletionOnlyCollator(tokenizer=tokenizer)
 
     # Training arguments
     training_args = TrainingArguments(
@@ -311,14 +443,31 @@ def main():
         max_grad_norm=args.max_grad_norm,
         fp16=args.fp16,
         bf16=args.bf16,
+        fp16_full_eval=args.fp16,
+        bf16_full_eval=args.bf16,
+        fsdp=args.fsdp or "",
+        # Wrap each decoder block (e.g. Qwen2DecoderLayer) as its own FSDP unit
+        fsdp_config={"transformer_layer_cls_to_wrap": model._no_split_modules} if args.fsdp else None,
+        deepspeed=args.deepspeed,
+        tf32=supports_tf32(),
         logging_steps=args.logging_steps,
+        save_strategy=args.save_strategy,
         save_steps=args.save_steps,
         eval_steps=args.eval_steps if eval_dataset else None,
-        evaluation_strategy="steps" if eval_dataset else "no",
-        save_total_limit=3,
-        load_best_model_at_end=True if eval_dataset else False,
+        evaluation_strategy=args.eval_strategy if eval_dataset else "no",
+        save_total_limit=1,
+        save_safetensors=True,
+        save_only_model=not args.save_optimizer_state,
+        load_best_model_at_end=args.load_best,
         report_to="tensorboard",
+        **dataloader_kwargs(pin_memory=torch.cuda.is_available()),
         seed=args.seed,
+        gradient_checkpointing=hf_gradient_checkpointing,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        # Batch similar lengths together to minimise padding
+        group_by_length=True,
+        length_column_name="length",
+        # prompt_length must reach the collator
         remove_unused_columns=False,
     )
 
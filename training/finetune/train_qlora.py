@@ -13,46 +13,51 @@ from pathlib import Path
 
 import torch
 from datasets import load_dataset, load_from_disk
-from peft import LoraConfig, TaskType, get_peft_model, prepare_model_for_kbit_training
+from peft import get_peft_model, prepare_model_for_kbit_training
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    DataCollatorForSeq2Seq,
-    Trainer,
     TrainingArguments,
 )
-from trl import SFTTrainer
+from trl import DataCollatorForCompletionOnlyLM, SFTTrainer
+
+from lora_utils import (
+    build_lora_config,
+    configure_torch_backends,
+    dataloader_kwargs,
+    get_attn_implementation,
+    kaiming_init_lora_weights_,
+    map_num_proc,
+    supports_tf32,
+)
 
 
-def get_chatml_template():
-    """Return ChatML format template for Qwen models."""
-    system_prompt = """You are an AI assistant that controls CesiumJS. Your task is to convert natural language commands into JSON tool calls. Always respond with valid JSON containing a "tool" field and an "arguments" field."""
+SYSTEM_PROMPT = """You are an AI assistant that controls CesiumJS. Your task is to convert natural language commands into JSON tool calls. Always respond with valid JSON containing a "tool" field and an "arguments" field."""
 
-    def format_example(instruction: str, output: str) -> str:
-        return f"""<|im_start|>system
+CHATML_TEMPLATE = """<|im_start|>system
 {system_prompt}<|im_end|>
 <|im_start|>user
 {instruction}<|im_end|>
 <|im_start|>assistant
 {output}<|im_end|>"""
 
-    return format_example
+# Loss starts after this marker when training unpacked (completion-only)
+RESPONSE_TEMPLATE = "<|im_start|>assistant\n"
 
 
 def formatting_prompts_func(examples):
     """Format examples for SFTTrainer."""
-    format_fn = get_chatml_template()
-
-    texts = []
-    for instruction, output in zip(examples["instruction"], examples["output"]):
-        text = format_fn(instruction, output)
-        texts.append(text)
-
+    texts = [
+        CHATML_TEMPLATE.format(system_prompt=SYSTEM_PROMPT, instruction=instruction, output=output)
+        for instruction, output in zip(examples["instruction"], examples["output"])
+    ]
     return {"text": texts}
 
 
 def main():
+    configure_torch_backends()
+
     parser = argparse.ArgumentParser(description="QLoRA fine-tuning for OrbPro2 MCP")
 
     # Model arguments
@@ -74,6 +79,8 @@ def main():
                        help="LoRA alpha")
     parser.add_argument("--lora-dropout", type=float, default=0.1,
                        help="LoRA dropout")
+    parser.add_argument("--lora-init-kaiming-fast", action="store_true",
+                       help="Initialise LoRA A matrices with one batched kaiming call per shape")
 
     # Training arguments
     parser.add_argument("--output-dir", type=str, default="./outputs/cesium-slm-qlora")
@@ -86,6 +93,18 @@ def main():
     parser.add_argument("--logging-steps", type=int, default=25)
     parser.add_argument("--save-steps", type=int, default=500)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-packing", action="store_true",
+                       help="Train on unpacked examples with loss on the response tokens only")
+    parser.add_argument("--save-optimizer-state", action="store_true",
+                       help="Keep optimizer/scheduler state in checkpoints (needed to resume)")
+    parser.add_argument("--no-compile", action="store_true",
+                       help="Disable torch.compile of the PEFT model")
+
+    # Multi-GPU scale-out (launch with torchrun / accelerate launch)
+    parser.add_argument("--fsdp", type=str, default=None,
+                       help='FSDP options, e.g. "full_shard auto_wrap"')
+    parser.add_argument("--deepspeed", type=str, default=None,
+                       help="Path to a DeepSpeed config JSON (e.g. ZeRO-2)")
 
     args = parser.parse_args()
 
@@ -98,6 +117,7 @@ def main():
         bnb_4bit_quant_type="nf4",
         bnb_4bit_compute_dtype=torch.bfloat16,
         bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_storage=torch.bfloat16,
     )
 
     # Load tokenizer
@@ -105,40 +125,64 @@ def main():
         args.model,
         trust_remote_code=True,
         padding_side="right",
+        use_fast=True,
     )
 
+    if not tokenizer.is_fast:
+        raise ValueError(f"No fast (Rust) tokenizer available for {args.model}")
+
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
     # Load model with 4-bit quantization
+    attn_implementation = get_attn_implementation(half_precision=True)
+    print(f"Attention implementation: {attn_implementation}")
+
+    # FSDP/DeepSpeed place and shard the model themselves (bf16 quant storage
+    # lets FSDP flatten the 4-bit weights); a single visible GPU needs no
+    # accelerate dispatch hooks
+    if args.fsdp or args.deepspeed:
+        device_map = None
+    else:
+        device_map = {"": 0} if torch.cuda.device_count() == 1 else "auto"
+
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
         trust_remote_code=True,
         quantization_config=bnb_config,
-        device_map="auto",
+        device_map=device_map,
         torch_dtype=torch.bfloat16,
+        attn_implementation=attn_implementation,
     )
 
     # Prepare for k-bit training
     model = prepare_model_for_kbit_training(model)
 
     # LoRA config (higher rank for QLoRA)
-    lora_config = LoraConfig(
-        task_type=TaskType.CAUSAL_LM,
-        r=args.lora_r,
-        lora_alpha=args.lora_alpha,
-        lora_dropout=args.lora_dropout,
-        target_modules=[
+    lora_config = build_lora_config(
+        args.lora_r,
+        args.lora_alpha,
+        args.lora_dropout,
+        [
             "q_proj", "k_proj", "v_proj", "o_proj",
             "gate_proj", "up_proj", "down_proj",
         ],
-        bias="none",
+        kaiming_fast=args.lora_init_kaiming_fast,
     )
 
     # Apply LoRA
     model = get_peft_model(model, lora_config)
+    if args.lora_init_kaiming_fast:
+        kaiming_init_lora_weights_(model)
     model.print_trainable_parameters()
 
+    # Fuse per-layer op chains with Inductor (compiled in place so the trainer
+    # still sees the PeftModel). mode="default": bitsandbytes 4-bit kernels
+    # don't compose with reduce-overhead CUDA graphs.
+    if torch.cuda.is_available() and not (args.no_compile or args.fsdp or args.deepspeed):
+        torch._dynamo.config.cache_size_limit = 64
+        model.compile(mode="default", dynamic=True)
+
     # Load datasets
     print(f"Loading training data: {args.train_file}")
 
@@ -160,18 +204,28 @@ def main():
             if hasattr(eval_dataset, "keys") and "test" in eval_dataset:
                 eval_dataset = eval_dataset["test"]
 
-    # Apply formatting
+    # Render the "text" column (parallel, cached by fingerprint); SFTTrainer
+    # tokenizes it and packs examples into full max_length windows.
+    map_kwargs = {
+        "batched": True,
+        "batch_size": 2000,
+        "writer_batch_size": 2000,
+        "num_proc": map_num_proc(),
+        "load_from_cache_file": True,
+        "desc": "format",
+    }
+
     train_dataset = train_dataset.map(
         formatting_prompts_func,
-        batched=True,
         remove_columns=train_dataset.column_names,
+        **map_kwargs,
     )
 
     if eval_dataset:
         eval_dataset = eval_dataset.map(
             formatting_prompts_func,
-            batched=True,
             remove_columns=eval_dataset.column_names,
+            **map_kwargs,
         )
 
     print(f"Training examples: {len(train_dataset)}")
@@ -189,35 +243,46 @@ def main():
         warmup_ratio=args.warmup_ratio,
         max_grad_norm=args.max_grad_norm,
         bf16=True,
+        bf16_full_eval=True,
+        fsdp=args.fsdp or "",
+        # Wrap each decoder block (e.g. Qwen2DecoderLayer) as its own FSDP unit
+        fsdp_config={"transformer_layer_cls_to_wrap": model._no_split_modules} if args.fsdp else None,
+        deepspeed=args.deepspeed,
+        tf32=supports_tf32(),
         logging_steps=args.logging_steps,
         save_steps=args.save_steps,
         evaluation_strategy="steps" if eval_dataset else "no",
         eval_steps=args.save_steps if eval_dataset else None,
         save_total_limit=3,
-        optim="paged_adamw_32bit",
+        save_safetensors=True,
+        save_only_model=not args.save_optimizer_state,
+        optim="paged_adamw_8bit",
         lr_scheduler_type="cosine",
         report_to="tensorboard",
+        **dataloader_kwargs(pin_memory=torch.cuda.is_available()),
         seed=args.seed,
         gradient_checkpointing=True,
         gradient_checkpointing_kwargs={"use_reentrant": False},
     )
 
-    # Data collator
-    data_collator = DataCollatorForSeq2Seq(
-        tokenizer=tokenizer,
-        model=model,
-        padding=True,
-        return_tensors="pt",
-    )
+    # Packing concatenates short examples (EOS-separated) so each max_length
+    # window is filled instead of padded, but then loss covers the whole
+    # sequence; unpacked runs mask everything up to the assistant turn.
+    data_collator = None
+    if args.no_packing:
+        data_collator = DataCollatorForCompletionOnlyLM(RESPONSE_TEMPLATE, tokenizer=tokenizer)
 
     # Initialize trainer
-    trainer = Trainer(
+    trainer = SFTTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         tokenizer=tokenizer,
         data_collator=data_collator,
+        packing=not args.no_packing,
+        max_seq_length=args.max_length,
+        dataset_text_field="text",
     )
 
     # Train
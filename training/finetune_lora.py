@@ -10,30 +10,28 @@ Usage:
 """
 
 import argparse
-import json
 import os
 from pathlib import Path
 
 import torch
-from datasets import Dataset
-from peft import LoraConfig, get_peft_model, TaskType
+from datasets import load_dataset
+from peft import get_peft_model
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
     Trainer,
-    DataCollatorForLanguageModeling,
 )
 
-
-def load_dataset(file_path: str) -> Dataset:
-    """Load the JSONL training dataset."""
-    data = []
-    with open(file_path, 'r') as f:
-        for line in f:
-            item = json.loads(line.strip())
-            data.append(item)
-    return Dataset.from_list(data)
+from finetune.lora_utils import (
+    CompletionOnlyCollator,
+    build_lora_config,
+    configure_torch_backends,
+    dataloader_kwargs,
+    get_attn_implementation,
+    kaiming_init_lora_weights_,
+    map_num_proc,
+)
 
 
 def format_prompt(instruction: str, output: str = None) -> str:
@@ -51,22 +49,27 @@ def format_prompt(instruction: str, output: str = None) -> str:
 
 
 def preprocess_function(examples, tokenizer, max_length=512):
-    """Tokenize the examples."""
-    prompts = [
+    """Tokenize the examples, with loss on the response tokens only."""
+    texts = [
         format_prompt(inst, out)
         for inst, out in zip(examples['instruction'], examples['output'])
     ]
+    prompts = [format_prompt(inst) for inst in examples['instruction']]
 
+    # No padding here: the collator pads each batch to its longest member
     tokenized = tokenizer(
-        prompts,
+        texts,
         truncation=True,
         max_length=max_length,
-        padding='max_length',
-        return_tensors='pt'
+        padding=False,
     )
+    prompt_ids = tokenizer(prompts, truncation=True, max_length=max_length)['input_ids']
 
-    # Set labels equal to input_ids for causal LM training
-    tokenized['labels'] = tokenized['input_ids'].clone()
+    # The collator masks these prompt tokens when it builds labels
+    tokenized['prompt_length'] = [len(prompt) for prompt in prompt_ids]
+
+    # Sequence lengths for length-grouped batching
+    tokenized['length'] = [len(ids) for ids in tokenized['input_ids']]
 
     return tokenized
 
@@ -83,6 +86,8 @@ def get_device():
 
 
 def main():
+    configure_torch_backends()
+
     parser = argparse.ArgumentParser(description='Fine-tune LLM for CesiumJS commands')
     parser.add_argument('--model_name', type=str, default='Qwen/Qwen2.5-0.5B-Instruct',
                        help='Base model name or path')
@@ -100,10 +105,28 @@ def main():
                        help='LoRA rank')
     parser.add_argument('--lora_alpha', type=int, default=32,
                        help='LoRA alpha')
+    parser.add_argument('--lora_init_kaiming_fast', '--lora-init-kaiming-fast', action='store_true',
+                       help='Initialise LoRA A matrices with one batched kaiming call per shape')
     parser.add_argument('--max_length', type=int, default=512,
                        help='Maximum sequence length')
+    parser.add_argument('--no_compile', action='store_true',
+                       help='Disable torch.compile of the PEFT model')
+    parser.add_argument('--save_optimizer_state', action='store_true',
+                       help='Keep optimizer/scheduler state in checkpoints (needed to resume)')
+    parser.add_argument('--merge_and_save', action='store_true',
+                       help='Also write a merged full model (needed for MLC conversion)')
+    # Multi-GPU scale-out (launch with torchrun / accelerate launch)
+    parser.add_argument('--fsdp', type=str, default=None,
+                       help='FSDP options, e.g. "full_shard auto_wrap"')
+    parser.add_argument('--deepspeed', type=str, default=None,
+                       help='Path to a DeepSpeed config JSON (e.g. ZeRO-2)')
     args = parser.parse_args()
 
+    # The best checkpoint is reloaded at the end; sharded checkpoints can only
+    # be reloaded through the full trainer state
+    if (args.fsdp or args.deepspeed) and not args.save_optimizer_state:
+        parser.error('--fsdp/--deepspeed requires --save_optimizer_state')
+
     # Detect device
     device, use_fp16, dtype = get_device()
     print(f"Using device: {device}")
@@ -112,16 +135,29 @@ def main():
     print(f"Loading model: {args.model_name}")
 
     # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name, trust_remote_code=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, trust_remote_code=True, use_fast=True)
+    if not tokenizer.is_fast:
+        raise ValueError(f"No fast (Rust) tokenizer available for {args.model_name}")
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
     # Load model
+    attn_implementation = get_attn_implementation(use_fp16)
+    print(f"Using attention: {attn_implementation}")
+
+    # FSDP/DeepSpeed place and shard the model themselves; a single visible
+    # GPU needs no accelerate dispatch hooks
+    if device == 'cuda' and not (args.fsdp or args.deepspeed):
+        device_map = {'': 0} if torch.cuda.device_count() == 1 else 'auto'
+    else:
+        device_map = None
+
     model = AutoModelForCausalLM.from_pretrained(
         args.model_name,
         torch_dtype=dtype,
-        device_map='auto' if device == 'cuda' else None,
+        device_map=device_map,
         trust_remote_code=True,
+        attn_implementation=attn_implementation,
     )
 
     # Move model to device for MPS (can't use device_map='auto')
@@ -129,47 +165,58 @@ def main():
         model = model.to(device)
 
     # Configure LoRA
-    lora_config = LoraConfig(
+    lora_config = build_lora_config(
         r=args.lora_r,
-        lora_alpha=args.lora_alpha,
-        lora_dropout=0.05,
+        alpha=args.lora_alpha,
+        dropout=0.05,
         target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj', 'gate_proj', 'up_proj', 'down_proj'],
-        bias='none',
-        task_type=TaskType.CAUSAL_LM,
+        kaiming_fast=args.lora_init_kaiming_fast,
     )
 
     # Apply LoRA
     model = get_peft_model(model, lora_config)
+    if args.lora_init_kaiming_fast:
+        kaiming_init_lora_weights_(model)
     model.print_trainable_parameters()
 
+    # Fuse per-layer op chains with Inductor; compiled in place so the Trainer
+    # and save_pretrained still see the PeftModel
+    if device == 'cuda' and not (args.no_compile or args.fsdp or args.deepspeed):
+        torch._dynamo.config.cache_size_limit = 64
+        model.compile(mode='reduce-overhead', dynamic=True)
+
     # Load and preprocess dataset
     print(f"Loading dataset: {args.dataset}")
-    dataset = load_dataset(args.dataset)
+    # Arrow-backed JSON reader (memory-mapped, no per-line Python parsing)
+    dataset = load_dataset('json', data_files=args.dataset, split='train')
 
     # Split into train/eval
     split_dataset = dataset.train_test_split(test_size=0.1, seed=42)
     train_dataset = split_dataset['train']
     eval_dataset = split_dataset['test']
 
-    # Tokenize
-    def tokenize_fn(examples):
-        return preprocess_function(examples, tokenizer, args.max_length)
+    # Tokenize (parallel workers, cached by dataset fingerprint)
+    map_kwargs = {
+        'fn_kwargs': {'tokenizer': tokenizer, 'max_length': args.max_length},
+        'batched': True,
+        'batch_size': 2000,
+        'writer_batch_size': 2000,
+        'num_proc': map_num_proc(),
+        'load_from_cache_file': True,
+        'desc': 'tokenize',
+    }
 
     train_dataset = train_dataset.map(
-        tokenize_fn,
-        batched=True,
-        remove_columns=train_dataset.column_names
+        preprocess_function,
+        remove_columns=train_dataset.column_names,
+        **map_kwargs
     )
     eval_dataset = eval_dataset.map(
-        tokenize_fn,
-        batched=True,
-        remove_columns=eval_dataset.column_names
+        preprocess_function,
+        remove_columns=eval_dataset.column_names,
+        **map_kwargs
     )
 
-    # Set format for PyTorch
-    train_dataset.set_format('torch')
-    eval_dataset.set_format('torch')
-
     # Training arguments
     training_args = TrainingArguments(
         output_dir=args.output_dir,
@@ -185,16 +232,23 @@ def main():
         eval_strategy='epoch',
         save_strategy='epoch',
         load_best_model_at_end=True,
+        save_safetensors=True,
+        save_only_model=not args.save_optimizer_state,
+        group_by_length=True,
+        length_column_name='length',
+        remove_unused_columns=False,  # prompt_length must reach the collator
         fp16=use_fp16,
         use_mps_device=(device == 'mps'),
+        fsdp=args.fsdp or '',
+        # Wrap each decoder block (e.g. Qwen2DecoderLayer) as its own FSDP unit
+        fsdp_config={'transformer_layer_cls_to_wrap': model._no_split_modules} if args.fsdp else None,
+        deepspeed=args.deepspeed,
         report_to='none',
+        **dataloader_kwargs(pin_memory=device == 'cuda'),
     )
 
-    # Data collator
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
+    # Data collator (dynamic padding; multiples of 8 keep tensor cores busy)
+    data_collator = CompletionOnlyCollator(tokenizer=tokenizer, pad_to_multiple_of=8)
 
     # Trainer
     trainer = Trainer(
@@ -214,14 +268,23 @@ def main():
     trainer.save_model()
     tokenizer.save_pretrained(args.output_dir)
 
-    # Merge LoRA weights for deployment
+    print("Training complete!")
+
+    if not args.merge_and_save:
+        print(f"\nLoRA adapter saved to {args.output_dir}")
+        print("Re-run with --merge_and_save to write a merged model for WebGPU conversion.")
+        return
+
+    # Merge LoRA weights for deployment (sharded safetensors, no pickle buffer)
     merged_dir = os.path.join(args.output_dir, 'merged')
     print(f"Merging LoRA weights to {merged_dir}")
     merged_model = model.merge_and_unload()
-    merged_model.save_pretrained(merged_dir)
+    merged_model.save_pretrained(merged_dir, safe_serialization=True, max_shard_size='2GB')
     tokenizer.save_pretrained(merged_dir)
+    del merged_model
+    if device == 'cuda':
+        torch.cuda.empty_cache()
 
-    print("Training complete!")
     print(f"\nTo convert for WebGPU, run:")
     print(f"  mlc_llm compile --model {merged_dir} --quantization q4f16_1 --target webgpu")
 
@@ -6,46 +6,174 @@ This is MUCH faster than PyTorch on Apple Silicon - typically 5-10x speedup.
 
 Requirements:
     pip install mlx mlx-lm
+    pip install orjson  # optional, faster dataset conversion
 
 Usage:
     python finetune_mlx.py --model Qwen/Qwen2.5-0.5B-Instruct --num-epochs 3
 """
 
 import argparse
+import hashlib
 import json
+import mmap
 import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
+import numpy as np
 
-def convert_jsonl_to_mlx_format(input_file: str, output_file: str):
-    """Convert our JSONL format to MLX chat format."""
-    data = []
-    with open(input_file, 'r') as f:
+from train_progress import run_with_progress
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj) -> bytes:
+        # Same output as orjson: compact, with non-ASCII kept as raw UTF-8
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+SPLIT_SEED = 42
+
+# Below this many records, process start-up outweighs parallel conversion
+PARALLEL_MIN_RECORDS = 20000
+
+# Output buffer size: record writes are coalesced into ~1 MiB write syscalls
+WRITE_BUFFER_SIZE = 1 << 20
+
+SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are a CesiumJS controller assistant. Convert natural language commands to tool calls."
+}
+
+
+def to_chat_record(line: bytes) -> dict:
+    """Parse one JSONL example and wrap it in MLX chat format (shared system message)."""
+    item = json_loads(line)
+    return {
+        "messages": [
+            SYSTEM_MSG,
+            {"role": "user", "content": item["instruction"]},
+            {"role": "assistant", "content": item["output"]},
+        ]
+    }
+
+
+def iter_chat_records(path: str):
+    """Yield our JSONL examples wrapped in MLX chat format."""
+    with open(path, 'rb') as f:
         for line in f:
-            item = json.loads(line.strip())
-            # MLX expects chat format with messages
-            data.append({
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a CesiumJS controller assistant. Convert natural language commands to tool calls."
-                    },
-                    {
-                        "role": "user",
-                        "content": item["instruction"]
-                    },
-                    {
-                        "role": "assistant",
-                        "content": item["output"]
-                    }
-                ]
-            })
-
-    with open(output_file, 'w') as f:
-        for item in data:
-            f.write(json.dumps(item) + '\n')
-
-    return len(data)
+            yield to_chat_record(line)
+
+
+def index_lines(buf) -> tuple:
+    """Return (starts, ends) byte offsets of the non-empty lines in a buffer."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(data)]))
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def write_if_changed(path: str, content: bytes) -> bool:
+    """Write content unless the file already holds identical bytes; return whether it was written."""
+    digest = hashlib.blake2b(content).digest()
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.blake2b(f.read()).digest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(content)
+    return True
+
+
+def convert_jsonl_to_mlx_format(input_file: str, output_file: str):
+    """Convert our JSONL format to MLX chat format, one record at a time."""
+    count = 0
+    with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        for record in iter_chat_records(input_file):
+            out.write(json_dumps(record) + b'\n')
+            count += 1
+
+    return count
+
+
+def split_cache_key(dataset: str, test_split: float) -> str:
+    """Key the converted split on the dataset file identity and split settings."""
+    st = os.stat(dataset)
+    parts = (os.path.realpath(dataset), st.st_size, st.st_mtime_ns, test_split, SPLIT_SEED, SYSTEM_MSG["content"])
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _convert_chunk(dataset: str, starts, ends, out_path: str) -> int:
+    """Write the chat-format records for the given line ranges, in order, to out_path."""
+    with open(dataset, 'rb') as src, \
+            mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            open(out_path, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            out.write(json_dumps(to_chat_record(mm[start:end])) + b'\n')
+    return len(starts)
+
+
+def write_chat_records(dataset: str, starts, ends, out_file: str, workers: int):
+    """Convert line ranges into out_file; large inputs are converted in parallel chunks."""
+    if workers <= 1 or len(starts) < PARALLEL_MIN_RECORDS:
+        _convert_chunk(dataset, starts, ends, out_file)
+        return
+
+    # Each worker writes its contiguous slice to a part file; parts are
+    # concatenated in order so the output matches a serial run
+    chunks = np.array_split(np.arange(len(starts)), workers)
+    part_files = [f"{out_file}.part{i}" for i in range(len(chunks))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(
+            _convert_chunk,
+            repeat(dataset),
+            [starts[c] for c in chunks],
+            [ends[c] for c in chunks],
+            part_files,
+        ))
+
+    with open(out_file, 'wb') as out:
+        for part_file in part_files:
+            with open(part_file, 'rb') as part:
+                shutil.copyfileobj(part, out, WRITE_BUFFER_SIZE)
+            os.remove(part_file)
+
+
+def split_to_mlx_format(dataset: str, train_file: str, valid_file: str, test_split: float,
+                        workers: int = None):
+    """Shuffle-split our JSONL into MLX chat-format train/valid files; return (n_train, n_valid)."""
+    workers = workers or os.cpu_count() or 1
+
+    # Index line offsets over a memory map; records are sliced and parsed
+    # only when written
+    with open(dataset, 'rb') as src, \
+            mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        starts, ends = index_lines(mm)
+
+    # Split into train/valid via a shuffled index permutation
+    order = np.random.default_rng(SPLIT_SEED).permutation(len(starts))
+    split_idx = int(len(starts) * (1 - test_split))
+    train_idx = order[:split_idx]
+    valid_idx = order[split_idx:]
+
+    # Write files (compact UTF-8 JSON lines)
+    write_chat_records(dataset, starts[train_idx], ends[train_idx], train_file, workers)
+    write_chat_records(dataset, starts[valid_idx], ends[valid_idx], valid_file, workers)
+
+    return len(train_idx), len(valid_idx)
 
 
 def main():
@@ -70,6 +198,14 @@ def main():
                        help='Fraction of data for validation')
     parser.add_argument('--iters', type=int, default=None,
                        help='Number of iterations (overrides epochs if set)')
+    parser.add_argument('--quantize', choices=['none', '4bit', '8bit'], default='none',
+                       help='Quantize the frozen base model before training (QLoRA)')
+    parser.add_argument('--progress', action='store_true',
+                       help='Show a compact progress display instead of the raw mlx_lm log')
+    parser.add_argument('--grad-checkpoint', action='store_true',
+                       help='Recompute activations in backward to fit larger batches')
+    parser.add_argument('--max-seq-length', type=int, default=None,
+                       help='Truncate training sequences to this many tokens')
     args = parser.parse_args()
 
     # Check MLX is available
@@ -82,68 +218,92 @@ def main():
         print("  pip install mlx mlx-lm")
         return 1
 
-    # Convert dataset to MLX format
-    dataset_dir = os.path.dirname(os.path.abspath(args.dataset)) or '.'
-    mlx_train_file = os.path.join(dataset_dir, 'train.jsonl')
-    mlx_valid_file = os.path.join(dataset_dir, 'valid.jsonl')
+    # mlx_lm trains on the default device; without Metal (e.g. Intel Macs)
+    # that is the CPU, which is far too slow for LoRA training
+    if 'gpu' not in str(mx.default_device()).lower():
+        print("ERROR: MLX fell back to CPU - training would be ~50x slower. Aborting.")
+        print("  MLX training requires an Apple Silicon Mac with Metal support")
+        return 1
 
-    print(f"Converting dataset: {args.dataset}")
+    # Resolve all paths once up front
+    dataset_path = Path(args.dataset).resolve()
+    dataset_dir = dataset_path.parent
+    output_dir = Path(args.output_dir).resolve()
+    merged_dir = output_dir / 'merged'
 
-    # Load and split data
-    all_data = []
-    with open(args.dataset, 'r') as f:
-        for line in f:
-            item = json.loads(line.strip())
-            all_data.append({
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a CesiumJS controller assistant. Convert natural language commands to tool calls."
-                    },
-                    {
-                        "role": "user",
-                        "content": item["instruction"]
-                    },
-                    {
-                        "role": "assistant",
-                        "content": item["output"]
-                    }
-                ]
-            })
-
-    # Split into train/valid
-    import random
-    random.seed(42)
-    random.shuffle(all_data)
-    split_idx = int(len(all_data) * (1 - args.test_split))
-    train_data = all_data[:split_idx]
-    valid_data = all_data[split_idx:]
-
-    # Write files
-    with open(mlx_train_file, 'w') as f:
-        for item in train_data:
-            f.write(json.dumps(item) + '\n')
-
-    with open(mlx_valid_file, 'w') as f:
-        for item in valid_data:
-            f.write(json.dumps(item) + '\n')
-
-    print(f"  Train: {len(train_data)} examples -> {mlx_train_file}")
-    print(f"  Valid: {len(valid_data)} examples -> {mlx_valid_file}")
+    # Convert dataset to MLX format
+    mlx_train_file = dataset_dir / 'train.jsonl'
+    mlx_valid_file = dataset_dir / 'valid.jsonl'
+
+    # Reuse the previous split when the dataset and split settings are unchanged
+    cache_file = dataset_dir / '.mlx_split_cache.json'
+    cache_key = split_cache_key(str(dataset_path), args.test_split)
+    cached = None
+    if mlx_train_file.exists() and mlx_valid_file.exists():
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+
+    if cached and cached.get("key") == cache_key:
+        n_train, n_valid = cached["train"], cached["valid"]
+        print(f"Reusing converted dataset for: {args.dataset}")
+    else:
+        print(f"Converting dataset: {args.dataset}")
+        n_train, n_valid = split_to_mlx_format(str(dataset_path), str(mlx_train_file), str(mlx_valid_file),
+                                               args.test_split)
+        with open(cache_file, 'wb') as f:
+            f.write(json_dumps({"key": cache_key, "train": n_train, "valid": n_valid}))
+
+    print(f"  Train: {n_train} examples -> {mlx_train_file}")
+    print(f"  Valid: {n_valid} examples -> {mlx_valid_file}")
 
     # Calculate iterations if not specified
     if args.iters is None:
-        steps_per_epoch = len(train_data) // args.batch_size
+        steps_per_epoch = n_train // args.batch_size
         args.iters = steps_per_epoch * args.num_epochs
         print(f"  Total iterations: {args.iters} ({args.num_epochs} epochs)")
 
     # Create output directory
-    os.makedirs(args.output_dir, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Quantize the frozen base once (reused across runs): less weight memory
+    # and bandwidth per step on unified memory
+    base_model = args.model
+    if args.quantize != 'none':
+        quantized_dir = output_dir / f'base-{args.quantize}'
+        base_model = str(quantized_dir)
+        # Sidecar recording which --model the quantized base was converted from
+        source_file = quantized_dir / '.source_model'
+        try:
+            source_model = source_file.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            source_model = None
+
+        if source_model == args.model and (quantized_dir / 'config.json').exists():
+            print(f"\nUsing quantized base model: {base_model}")
+        else:
+            # mlx_lm.convert refuses to write into an existing directory
+            if quantized_dir.exists():
+                shutil.rmtree(quantized_dir)
+            convert_cmd = [
+                "python3", "-m", "mlx_lm.convert",
+                "--hf-path", args.model,
+                "--mlx-path", base_model,
+                "-q", "--q-bits", args.quantize[0],
+            ]
+            print("\nQuantizing base model...")
+            print("Running:", " ".join(convert_cmd))
+            if subprocess.run(convert_cmd).returncode != 0:
+                print("\nQuantization failed")
+                return 1
+            source_file.write_text(args.model, encoding='utf-8')
 
     # Run MLX LoRA training
     print(f"\nStarting MLX LoRA training...")
-    print(f"  Model: {args.model}")
-    print(f"  Output: {args.output_dir}")
+    print(f"  Model: {args.model}" + (f" ({args.quantize})" if args.quantize != 'none' else ""))
+    print(f"  Output: {output_dir}")
     print(f"  LoRA rank: {args.lora_rank}")
     print(f"  Learning rate: {args.learning_rate}")
     print(f"  Batch size: {args.batch_size}")
@@ -151,7 +311,7 @@ def main():
     print()
 
     # Create LoRA config file
-    config_file = os.path.join(dataset_dir, 'lora_config.yaml')
+    config_file = dataset_dir / 'lora_config.yaml'
     config_content = f"""# LoRA configuration
 lora_parameters:
   rank: {args.lora_rank}
@@ -159,17 +319,15 @@ lora_parameters:
   dropout: 0.05
   scale: 1.0
 """
-    with open(config_file, 'w') as f:
-        f.write(config_content)
+    write_if_changed(str(config_file), config_content.encode('utf-8'))
 
     # Use mlx_lm lora to train (new CLI format)
-    import subprocess
     cmd = [
         "python3", "-m", "mlx_lm", "lora",
-        "--model", args.model,
+        "--model", base_model,
         "--train",
-        "--data", dataset_dir,
-        "--adapter-path", os.path.abspath(args.output_dir),
+        "--data", str(dataset_dir),
+        "--adapter-path", str(output_dir),
         "--iters", str(args.iters),
         "--batch-size", str(args.batch_size),
         "--learning-rate", str(args.learning_rate),
@@ -178,44 +336,52 @@ lora_parameters:
         "--steps-per-eval", "200",
         "--steps-per-report", "10",
         "--save-every", "1000",
-        "--config", config_file,
+        "--config", str(config_file),
     ]
+    if args.grad_checkpoint:
+        cmd.append("--grad-checkpoint")
+    if args.max_seq_length is not None:
+        cmd += ["--max-seq-length", str(args.max_seq_length)]
 
     print("Running:", " ".join(cmd))
     print("-" * 60)
 
-    result = subprocess.run(cmd, cwd=dataset_dir)
+    if args.progress:
+        returncode = run_with_progress(cmd, args.iters, cwd=dataset_dir)
+    else:
+        returncode = subprocess.run(cmd, cwd=dataset_dir).returncode
 
-    if result.returncode != 0:
-        print(f"\nTraining failed with code {result.returncode}")
+    if returncode != 0:
+        print(f"\nTraining failed with code {returncode}")
         return 1
 
+    # Fuse the adapter with the base model; it only needs the adapter files
+    # already on disk, so start it now and report while it runs
+    fuse_cmd = [
+        "python", "-m", "mlx_lm.fuse",
+        "--model", base_model,
+        "--adapter-path", str(output_dir),
+        "--save-path", str(merged_dir),
+    ]
+    if args.quantize != 'none':
+        # WebGPU conversion expects full-precision weights
+        fuse_cmd.append("--de-quantize")
+    fuse_process = subprocess.Popen(fuse_cmd)
+
     print("\n" + "=" * 60)
     print("Training complete!")
-    print(f"Adapter saved to: {args.output_dir}")
+    print(f"Adapter saved to: {output_dir}")
     print()
 
-    # Fuse the adapter with the base model
     print("Fusing LoRA adapter with base model...")
-    merged_dir = os.path.join(args.output_dir, 'merged')
-
-    fuse_cmd = [
-        "python", "-m", "mlx_lm.fuse",
-        "--model", args.model,
-        "--adapter-path", args.output_dir,
-        "--save-path", merged_dir,
-    ]
-
     print("Running:", " ".join(fuse_cmd))
-    result = subprocess.run(fuse_cmd)
-
-    if result.returncode == 0:
+    if fuse_process.wait() == 0:
         print(f"\nMerged model saved to: {merged_dir}")
         print("\nTo convert for WebGPU, run:")
         print(f"  ./scripts/compile-cesium-slm-docker.sh")
     else:
         print("\nFuse failed - you can run it manually later:")
-        print(f"  python -m mlx_lm.fuse --model {args.model} --adapter-path {args.output_dir} --save-path {merged_dir}")
+        print(f"  {' '.join(fuse_cmd)}")
 
     return 0
 
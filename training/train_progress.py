@@ -2,24 +2,48 @@
 """
 Wrapper for MLX training with clean progress output.
 Clears terminal and shows only: Training header + status + progress bar.
+
+Also importable: finetune_mlx.py calls run_with_progress() directly.
 """
 
 import sys
 import re
 import subprocess
 import shutil
+import signal
 import os
+from functools import lru_cache
+
+# MLX progress lines all start with "Iter "; patterns are anchored and only
+# tried on lines that pass that cheap prefix check. Matching runs on raw
+# bytes; only the numeric capture groups are converted.
+ITER_PATTERN = re.compile(rb'^Iter (\d+): Train loss ([\d.]+).*It/sec ([\d.]+).*Tokens/sec ([\d.]+).*Peak mem ([\d.]+)')
+VAL_PATTERN = re.compile(rb'^Iter \d+: Val loss ([\d.]+)')
+SAVE_MARKER = b'Saved adapter weights'
+
+_term_width = None
 
 def get_terminal_width():
-    return shutil.get_terminal_size().columns
+    """Terminal width, queried once and then cached until the next SIGWINCH."""
+    global _term_width
+    if _term_width is None:
+        _term_width = shutil.get_terminal_size().columns
+    return _term_width
+
+def _on_resize(signum, frame):
+    global _term_width
+    _term_width = None
+
+@lru_cache(maxsize=None)
+def _bar(filled, width):
+    return '█' * filled + '░' * (width - filled)
 
 def create_progress_bar(current, total, width=50):
     if total == 0:
-        return "[" + "░" * width + "]   0.0%"
+        return f"[{_bar(0, width)}]   0.0%"
     filled = int(width * current / total)
-    bar = '█' * filled + '░' * (width - filled)
     percent = current / total * 100
-    return f"[{bar}] {percent:5.1f}%"
+    return f"[{_bar(filled, width)}] {percent:5.1f}%"
 
 def clear_screen():
     """Clear terminal and move cursor to top."""
@@ -27,39 +51,58 @@ def clear_screen():
     sys.stdout.write('\033[H')   # Move cursor to home
     sys.stdout.flush()
 
-def move_to_top():
-    """Move cursor to home position."""
-    sys.stdout.write('\033[H')
+def print_header():
+    """Print the fixed header once; render() only redraws the lines below it."""
+    global _last_frame
+    _last_frame = None
+    sys.stdout.write('\033[1;33mTraining\033[0m\n\n')  # Yellow bold
     sys.stdout.flush()
 
-def render(status, progress, term_width):
-    """Render the display (header + status + progress)."""
-    move_to_top()
+_last_frame = None
 
-    # Clear and print header
-    print('\033[K' + '\033[1;33mTraining\033[0m')  # Yellow bold
-    print('\033[K')  # Empty line
+def render(status, progress, term_width):
+    """Redraw the status + progress lines in place; unchanged frames are skipped."""
+    global _last_frame
 
     # Truncate status if needed
     if len(status) > term_width - 2:
         status = status[:term_width - 5] + "..."
 
-    print('\033[K' + status)
-    print('\033[K' + progress)
-
-    # Clear any leftover lines below
-    print('\033[K')
+    frame = (status, progress)
+    if frame == _last_frame:
+        return
 
+    # Step back over the previous frame (if any) instead of jumping home
+    up = '\033[2A' if _last_frame is not None else ''
+    sys.stdout.write(f'{up}\r\033[K{status}\n\r\033[K{progress}\n')
     sys.stdout.flush()
-
-def main():
-    if len(sys.argv) < 3:
-        print("Usage: train_progress.py <total_iters> <command...>")
-        sys.exit(1)
-
-    total_iters = int(sys.argv[1])
-    cmd = sys.argv[2:]
-
+    _last_frame = frame
+
+def iter_line_batches(stream, chunk_size=65536):
+    """Yield the complete lines (bytes) of each large read1() chunk from a binary pipe, as a list.
+
+    A batch holds everything the pipe had buffered at that moment, so callers
+    can act once per batch instead of once per line.
+    """
+    pending = bytearray()
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        end = pending.rfind(b'\n')
+        if end < 0:
+            continue
+        yield bytes(pending[:end]).split(b'\n')
+        del pending[:end + 1]
+    if pending:
+        yield [bytes(pending)]
+
+def run_with_progress(cmd, total_iters, cwd=None):
+    """Run an MLX training command, showing parsed progress instead of its raw log.
+
+    Returns the command's exit code.
+    """
     # Track state
     current_iter = 0
     train_loss = 0.0
@@ -68,69 +111,83 @@ def main():
     peak_mem = 0.0
     saved = False
 
-    # Regex patterns for MLX output
-    iter_pattern = re.compile(r'Iter (\d+): Train loss ([\d.]+).*It/sec ([\d.]+).*Tokens/sec ([\d.]+).*Peak mem ([\d.]+)')
-    val_pattern = re.compile(r'Iter \d+: Val loss ([\d.]+)')
-    save_pattern = re.compile(r'Saved adapter weights')
-
     process = subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1
+        bufsize=65536,
+        cwd=cwd,
     )
 
-    term_width = get_terminal_width()
+    if hasattr(signal, 'SIGWINCH'):
+        signal.signal(signal.SIGWINCH, _on_resize)
 
     # Clear screen and show initial state
     clear_screen()
+    print_header()
 
     # Initial render
+    term_width = get_terminal_width()
     bar_width = min(50, term_width - 20)
     status = f"iter:0/{total_iters} | loss:-.--- | 0 tok/s | 0.0GB"
     progress = create_progress_bar(0, total_iters, bar_width)
     render(status, progress, term_width)
 
+    def redraw():
+        save_indicator = " 💾" if saved else ""
+        val_indicator = f" | val:{val_loss:.3f}" if val_loss > 0 else ""
+        status = f"iter:{current_iter}/{total_iters} | loss:{train_loss:.3f}{val_indicator} | {tokens_per_sec:.0f} tok/s | {peak_mem:.1f}GB{save_indicator}"
+
+        # Progress bar (width follows terminal resizes)
+        term_width = get_terminal_width()
+        bar_width = min(50, term_width - 20)
+        progress = create_progress_bar(current_iter, total_iters, bar_width)
+
+        render(status, progress, term_width)
+
     try:
-        for line in process.stdout:
-            line = line.strip()
-
-            # Parse iteration info
-            iter_match = iter_pattern.search(line)
-            if iter_match:
-                current_iter = int(iter_match.group(1))
-                train_loss = float(iter_match.group(2))
-                tokens_per_sec = float(iter_match.group(4))
-                peak_mem = float(iter_match.group(5))
-                saved = False  # Reset save indicator
-
-            # Parse validation loss
-            val_match = val_pattern.search(line)
-            if val_match:
-                val_loss = float(val_match.group(1))
-
-            # Check for save
-            if save_pattern.search(line):
-                saved = True
-
-            # Only update display on training iterations
-            if iter_match or val_match:
-                # Build status line
-                save_indicator = " 💾" if saved else ""
-                val_indicator = f" | val:{val_loss:.3f}" if val_loss > 0 else ""
-                status = f"iter:{current_iter}/{total_iters} | loss:{train_loss:.3f}{val_indicator} | {tokens_per_sec:.0f} tok/s | {peak_mem:.1f}GB{save_indicator}"
-
-                # Progress bar
-                progress = create_progress_bar(current_iter, total_iters, bar_width)
-
-                # Render
-                render(status, progress, term_width)
+        for lines in iter_line_batches(process.stdout):
+            dirty = False
+
+            for line in lines:
+                line = line.strip()
+
+                if not line.startswith(b'Iter '):
+                    continue
+
+                # Parse iteration info
+                iter_match = ITER_PATTERN.match(line)
+                if iter_match:
+                    current_iter = int(iter_match.group(1))
+                    train_loss = float(iter_match.group(2))
+                    tokens_per_sec = float(iter_match.group(4))
+                    peak_mem = float(iter_match.group(5))
+                    saved = False  # Reset save indicator
+
+                # Parse validation loss
+                val_match = None if iter_match else VAL_PATTERN.match(line)
+                if val_match:
+                    val_loss = float(val_match.group(1))
+
+                # Check for save
+                if SAVE_MARKER in line:
+                    saved = True
+
+                # Only update display on training iterations
+                if iter_match or val_match:
+                    dirty = True
+
+            # Repaint once per pipe read: lines that arrive together (e.g. an
+            # eval step's val + train lines) share one frame, and the newest
+            # state is always on screen
+            if dirty:
+                redraw()
 
     except KeyboardInterrupt:
         process.terminate()
+        process.wait()
         print("\n\nTraining interrupted.")
-        sys.exit(1)
+        return 1
 
     process.wait()
 
@@ -144,5 +201,12 @@ def main():
 
     return process.returncode
 
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: train_progress.py <total_iters> <command...>")
+        sys.exit(1)
+
+    return run_with_progress(sys.argv[2:], int(sys.argv[1]))
+
 if __name__ == '__main__':
     sys.exit(main())